@@ -0,0 +1,94 @@
+import os
+
+import requests
+
+# Stand-ins for the pywikibot classes upload.py uses, talking to the fake
+# MediaWiki API of bench/standin.py at BENCH_API_URL over HTTP, so that uploads
+# and edits cost requests and bytes on the wire as they would against Commons.
+API_URL = os.environ.get("BENCH_API_URL")
+
+session = requests.Session()
+
+
+def api(params, data=None, **kwargs):
+    resp = session.post(API_URL, params=params, data=data, **kwargs)
+    resp.raise_for_status()
+    return resp.json()
+
+
+class Site:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def login(self, cookie_only=False):
+        pass
+
+    def preloadpages(self, pages, groupsize=50, **kwargs):
+        pages = list(pages)
+        for i in range(0, len(pages), groupsize):
+            group = pages[i : i + groupsize]
+            texts = api(
+                {"action": "query"},
+                {"titles": "|".join(page.title() for page in group)},
+            )
+            for page in group:
+                page._text = texts[page.title()]
+                page._loaded = True
+                yield page
+
+    def upload(self, source_filename, filepage, text, comment, chunk_size, **kwargs):
+        key = None
+        with open(source_filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                params = {"action": "upload"}
+                if key:
+                    params["stashkey"] = key
+                key = api(
+                    params,
+                    chunk,
+                    headers={"Content-Type": "application/octet-stream"},
+                )["filekey"]
+        result = api(
+            {"action": "upload"},
+            {"filekey": key, "filename": filepage.title(), "text": text},
+        )
+        filepage._text = text
+        return result["result"] == "Success"
+
+
+class Page:
+    def __init__(self, site, title):
+        self.site = site
+        self._title = title
+        self._text = None
+        self._loaded = False
+
+    def title(self, **kwargs):
+        return self._title
+
+    def _load(self):
+        if not self._loaded:
+            self._text = api({"action": "query"}, {"titles": self._title})[self._title]
+            self._loaded = True
+
+    def exists(self):
+        self._load()
+        return self._text is not None
+
+    @property
+    def text(self):
+        self._load()
+        return self._text or ""
+
+    @text.setter
+    def text(self, value):
+        self._new_text = value
+
+    def save(self, summary=None, **kwargs):
+        api({"action": "edit"}, {"title": self._title, "text": self._new_text})
+        self._text = self._new_text
+        return True
+
+
+class FilePage(Page):
+    pass
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Compares the PicView gallery extraction of the crawler with the BeautifulSoup
+# parsing it replaced, on the saved PicView pages in fixtures/picview and on those
+# in the crawler's response cache, if any.
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT / "crawler"))
+import crawl
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "picview"
+
+
+def fixture_pages(fixtures_dir):
+    for path in sorted(Path(fixtures_dir).glob("*.html")):
+        yield path.read_bytes()
+
+
+def cached_pages(cache_dir):
+    for meta_path in sorted(Path(cache_dir).glob("*/*.json")):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if "/PicView" in meta["url"]:
+            yield meta_path.with_suffix(".body").read_bytes()
+
+
+def soup_sources(content):
+    html = BeautifulSoup(content, features="lxml")
+    return [img.attrs["src"] for img in html.select("#galley li img")]
+
+
+def timed(fn, pages, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = [fn(page) for page in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the PicView gallery extraction of the crawler"
+    )
+    parser.add_argument("--cache-dir", type=Path, default=crawl.CACHE_DIR)
+    parser.add_argument("--fixtures-dir", type=Path, default=FIXTURES_DIR)
+    parser.add_argument("-r", "--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    fixtures = list(fixture_pages(args.fixtures_dir))
+    cached = list(cached_pages(args.cache_dir)) if args.cache_dir.exists() else []
+    pages = fixtures + cached
+    images = sum(page.lower().count(b"<img") for page in pages)
+    size = sum(map(len, pages))
+    print(
+        f"{len(fixtures)} fixtures and {len(cached)} cached responses, "
+        f"{images} images, {size / 2**20:.1f} MiB"
+    )
+
+    old_time, old = timed(soup_sources, pages, args.rounds)
+    new_time, new = timed(crawl.gallery_sources, pages, args.rounds)
+    mismatches = sum(a != b for a, b in zip(old, new))
+    for name, t in (("BeautifulSoup", old_time), ("lxml XPath", new_time)):
+        print(f"{name:>14}: {t:.3f} s, {t / len(pages) * 1000:.2f} ms/page")
+    print(f"speed-up: {old_time / new_time:.1f}x, mismatches: {mismatches}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Runs the crawler, the planner and the uploader end to end against local
+# stand-ins (bench/standin.py), with latency and failures injected as asked, and
+# reports per stage: wall time, requests/s, MB/s, peak RSS and the time spent in
+# each step. With --output, the results are saved as JSON; with --baseline, they
+# are compared to results saved before.
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from collections import defaultdict
+from tempfile import TemporaryDirectory
+
+from standin import Standin
+
+ROOT = Path(__file__).resolve().parent.parent
+STAGES = ("crawl", "plan", "upload")
+
+
+def run_stage(stage, standin, args, work_dir):
+    stats_path = work_dir / f"{stage}.jsonl"
+    command = [
+        sys.executable,
+        str(Path(__file__).parent / "stages.py"),
+        stage,
+        "--base-url",
+        standin.base_url,
+        "--data-dir",
+        str(work_dir / "data"),
+        "--work-dir",
+        str(work_dir),
+        "--stats",
+        str(stats_path),
+        "-j",
+        str(args.crawl_workers if stage == "crawl" else args.upload_workers),
+        *(arg for item in args.config for arg in ("--config", item)),
+    ]
+    env = {**os.environ, "LOGLEVEL": args.loglevel}
+    before = standin.stats()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    process.wait()
+    seconds = time.perf_counter() - start
+    if process.returncode:
+        sys.exit(f"Stage {stage} failed with {process.returncode}")
+    after = standin.stats()
+
+    def delta(kind):
+        return {
+            key: value - before[kind].get(key, 0)
+            for key, value in after[kind].items()
+            if value - before[kind].get(key, 0)
+        }
+
+    steps = defaultdict(lambda: defaultdict(float))
+    peak_rss = 0
+    if stats_path.exists():
+        with open(stats_path) as f:
+            for line in f:
+                record = json.loads(line)
+                if "peak_rss_mb" in record:
+                    # of any one of the stage's processes
+                    peak_rss = max(peak_rss, record["peak_rss_mb"])
+                    continue
+                step = steps[record.pop("step")]
+                step["calls"] += 1
+                for key, value in record.items():
+                    step[key] += value
+    requests = delta("requests")
+    sent = sum(delta("bytes_sent").values())
+    received = sum(delta("bytes_received").values())
+    return {
+        "seconds": seconds,
+        "peak_rss_mb": peak_rss,
+        "requests": requests,
+        "requests_per_s": sum(requests.values()) / seconds,
+        "failures": delta("failures"),
+        "mb_in_per_s": sent / 2**20 / seconds,
+        "mb_out_per_s": received / 2**20 / seconds,
+        "steps": steps,
+    }
+
+
+def report(results, baseline=None):
+    for stage, result in results.items():
+        old = (baseline or {}).get(stage)
+
+        def compare(key, fmt):
+            value = fmt.format(result[key])
+            if old and old.get(key):
+                value += f" ({result[key] / old[key]:.2f}x baseline)"
+            return value
+
+        print(f"== {stage}")
+        print(f"   wall:      {compare('seconds', '{:.2f} s')}")
+        print(f"   requests:  {compare('requests_per_s', '{:.1f} req/s')}")
+        print(f"   received:  {compare('mb_in_per_s', '{:.2f} MB/s')}")
+        print(f"   sent:      {compare('mb_out_per_s', '{:.2f} MB/s')}")
+        print(f"   peak RSS:  {compare('peak_rss_mb', '{:.0f} MB')}")
+        if result["failures"]:
+            print(f"   injected:  {dict(result['failures'])}")
+        for endpoint, count in sorted(result["requests"].items()):
+            print(f"   {endpoint:>10}: {count} requests")
+        for name, step in result["steps"].items():
+            line = (
+                f"   {name:>10}: {step['calls']:.0f} calls, {step['seconds']:.2f} s,"
+                f" {step['seconds'] / step['calls'] * 1000:.1f} ms/call"
+            )
+            if step.get("images"):
+                line += f", {step['images'] / result['seconds']:.1f} pages/s"
+            if step.get("bytes"):
+                line += f", {step['bytes'] / 2**20 / step['seconds']:.2f} MB/s"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline end to end against local stand-ins"
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=ROOT / "crawler" / "data",
+        help="crawled data for the stand-ins to serve",
+    )
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument(
+        "--max-images", type=int, default=20, help="per volume, 0 for all"
+    )
+    parser.add_argument("--image-size", default="2000x3000", help="WxH of the pages")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--crawl-workers", type=int, default=8)
+    parser.add_argument("--upload-workers", type=int, default=1)
+    parser.add_argument(
+        "--config",
+        action="append",
+        default=[],
+        metavar="KEY=JSON",
+        help="set an option of the uploader's config.yml, e.g. download_concurrency=16",
+    )
+    parser.add_argument(
+        "--stages", default=",".join(STAGES), help="comma separated, in order"
+    )
+    parser.add_argument("--loglevel", default="WARNING")
+    parser.add_argument("-o", "--output", type=Path, help="save the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="results to compare to")
+    args = parser.parse_args()
+
+    standin = Standin(
+        args.data_dir,
+        books=args.books,
+        max_images=args.max_images,
+        image_size=tuple(map(int, args.image_size.split("x"))),
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        truncate_rate=args.truncate_rate,
+        seed=args.seed,
+    )
+    standin.serve()
+    results = {}
+    with TemporaryDirectory(prefix="ynutcm-bench-") as work_dir:
+        work_dir = Path(work_dir)
+        (work_dir / "data").mkdir()
+        for stage in args.stages.split(","):
+            results[stage] = run_stage(stage, standin, args, work_dir)
+    standin.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"args": vars(args), "results": results}, f, indent=1, default=str
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# The stages of the pipeline as bench/run.py runs them, each in a process of its
+# own: the crawler and the uploader pointed at the stand-ins, with the time spent
+# in their steps appended to a JSON Lines file.
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+
+def rebase(url, base_url):
+    # -> `url` with its scheme and host swapped for those of `base_url`
+    split = urlsplit(url)
+    return base_url + split.path + (f"?{split.query}" if split.query else "")
+
+
+def timed(stats_path, step, fn, measure=None):
+    # `fn`, with the time each call takes, and whatever `measure` makes of the
+    # arguments and the result, appended to `stats_path`
+    @functools.wraps(fn)
+    def wrapped(*args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        record = {"step": step, "seconds": time.perf_counter() - start}
+        if measure is not None:
+            record.update(measure(args, kwargs, result))
+        # one small append per line, so the lines of several processes do not mix
+        with open(stats_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return result
+
+    return wrapped
+
+
+def record_peak_rss(stats_path):
+    # VmHWM, unlike ru_maxrss, starts over on exec, so it does not count the
+    # benchmark process the stage was started from
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                peak = int(line.split()[1]) / 1024
+    with open(stats_path, "a") as f:
+        f.write(json.dumps({"peak_rss_mb": peak}) + "\n")
+
+
+def crawl_stage(args):
+    sys.path.insert(0, str(ROOT / "crawler"))
+    import crawl
+
+    crawl.URL_PAGER = rebase(crawl.URL_PAGER, args.base_url)
+    crawl.URL_BOOK_DETAIL = rebase(crawl.URL_BOOK_DETAIL, args.base_url)
+    crawl.URL_VOLUME_VIEW = rebase(crawl.URL_VOLUME_VIEW, args.base_url)
+    crawl.OUTPUT_DIR = args.data_dir
+    crawl.pager = timed(args.stats, "pager", crawl.pager)
+    crawl.book_detail = timed(args.stats, "detail", crawl.book_detail)
+    crawl.volume_images = timed(
+        args.stats,
+        "picview",
+        crawl.volume_images,
+        lambda args, kwargs, result: {"images": len(result)},
+    )
+    sys.argv = ["crawl.py", "--no-cache", "--rate", "0", "-j", str(args.workers)]
+    crawl.main()
+
+
+def write_config(path, extra):
+    config = {
+        "username": "bench",
+        "password": "bench",
+        "template": "YNUTCM-bench",
+        "booknavi": "YNUTCM-navi",
+        "name": "[[Category:Bench]]",
+        "skip_on_failures": True,
+        "edits_per_minute": 0,
+        "download_rate": 0,
+        "blob_store_size": 0,
+    }
+    for item in extra:
+        key, value = item.split("=", 1)
+        config[key] = json.loads(value)
+    with open(path, "w") as f:
+        json.dump(config, f)  # JSON is YAML, too
+
+
+def plan_stage(args):
+    sys.path.insert(0, str(ROOT / "uploader"))
+    import plan
+
+    plan.CONFIG_FILE_PATH = args.work_dir / "config.yml"
+    plan.DATA_DIR = args.data_dir
+    write_config(plan.CONFIG_FILE_PATH, args.config)
+    sys.argv = ["plan.py", str(args.work_dir / "manifest.json")]
+    try:
+        plan.main()
+    except SystemExit as e:
+        # colliding file names do not matter here
+        if e.code != 1:
+            raise
+
+
+def upload_stage(args):
+    sys.path.insert(0, str(ROOT / "uploader"))
+    os.environ["BENCH_API_URL"] = args.base_url + "/w/api.php"
+    import plan
+    import upload
+    import fakewiki
+
+    plan.CONFIG_FILE_PATH = args.work_dir / "config.yml"
+    write_config(
+        plan.CONFIG_FILE_PATH,
+        [f'journal="{args.work_dir / "journal.sqlite"}"', *args.config],
+    )
+    upload.WORK_DIR = args.work_dir / "work"
+    upload.BLOB_DIR = args.work_dir / "blobs"
+    for name in ("Site", "Page", "FilePage"):
+        setattr(upload, name, getattr(fakewiki, name))
+    upload.fetch_volume = timed(
+        args.stats,
+        "download",
+        upload.fetch_volume,
+        lambda args, kwargs, result: {
+            "images": len(args[1]),
+            "bytes": result.stat().st_size,
+        },
+    )
+    fakewiki.Site.upload = timed(
+        args.stats,
+        "upload",
+        fakewiki.Site.upload,
+        lambda args, kwargs, result: {
+            "bytes": os.path.getsize(kwargs["source_filename"])
+        },
+    )
+    fakewiki.Page.save = timed(args.stats, "edit", fakewiki.Page.save)
+    # from the worker processes, too, which are done once their prefetcher is
+    prefetcher_exit = upload.Prefetcher.__exit__
+
+    def exit_prefetcher(self, *exc):
+        prefetcher_exit(self, *exc)
+        record_peak_rss(args.stats)
+
+    upload.Prefetcher.__exit__ = exit_prefetcher
+    sys.argv = [
+        "upload.py",
+        "--manifest",
+        str(args.work_dir / "manifest.json"),
+        "-j",
+        str(args.workers),
+    ]
+    upload.main()
+
+
+STAGES = {"crawl": crawl_stage, "plan": plan_stage, "upload": upload_stage}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one stage of the benchmark")
+    parser.add_argument("stage", choices=STAGES)
+    parser.add_argument("--base-url", required=True)
+    parser.add_argument("--data-dir", type=Path, required=True)
+    parser.add_argument("--work-dir", type=Path, required=True)
+    parser.add_argument("--stats", type=Path, required=True)
+    parser.add_argument("-j", "--workers", type=int, default=1)
+    parser.add_argument(
+        "--config",
+        action="append",
+        default=[],
+        metavar="KEY=JSON",
+        help="set an option of the uploader's config.yml",
+    )
+    args = parser.parse_args()
+    try:
+        STAGES[args.stage](args)
+    finally:
+        record_peak_rss(args.stats)
+
+
+if __name__ == "__main__":
+    main()
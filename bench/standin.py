@@ -0,0 +1,280 @@
+import io
+import json
+import time
+import random
+import threading
+import urllib.parse
+import http.server
+from pathlib import Path
+from collections import Counter
+
+from PIL import Image
+
+# Local stand-ins for the YNUTCM endpoints the crawler and the uploader talk to,
+# i.e. Pager, Detail_gj, PicView and the image host, and for the MediaWiki API,
+# serving the books of a crawled data directory.
+#
+# Every request can be delayed by `latency` seconds give or take `jitter`, and
+# fail with a 500 at `failure_rate`. Images are cut short at `truncate_rate`
+# instead, with the full Content-Length announced and Range supported, the way a
+# flaky link would.
+
+PAGE_SIZE = 12
+# distinct images served, round robin, for all the pages of all the books
+DISTINCT_IMAGES = 8
+
+
+def make_images(size, count=DISTINCT_IMAGES):
+    # blotchy noise, which compresses about as well as a scanned page
+    images = []
+    for i in range(count):
+        small = Image.effect_noise((size[0] // 16, size[1] // 16), 64 + i)
+        img = Image.merge(
+            "RGB",
+            [
+                small.point(lambda v, tint=tint: min(255, v + tint))
+                for tint in (90, 70, 40)
+            ],
+        ).resize(size, Image.BICUBIC)
+        blob = io.BytesIO()
+        img.save(blob, format="JPEG", quality=85, dpi=(300, 300))
+        images.append(blob.getvalue())
+    return images
+
+
+class Standin:
+    def __init__(
+        self,
+        data_dir,
+        books=None,
+        max_images=None,
+        image_size=(2000, 3000),
+        latency=0.0,
+        jitter=0.0,
+        failure_rate=0.0,
+        truncate_rate=0.0,
+        seed=0,
+    ):
+        self.books = {}
+        for path in sorted(Path(data_dir).glob("*.json"))[:books]:
+            with open(path) as f:
+                book = json.load(f)
+            self.books[book["detail"]["Id"]] = book
+        self.ids = sorted(
+            self.books,
+            key=lambda book_id: self.books[book_id]["detail"]["UpdateTime"] or "",
+            reverse=True,
+        )
+        self.volumes = {
+            volume["tpath"]: (book_id, nth, len(volume.get("IMAGES", [])))
+            for book_id, book in self.books.items()
+            for nth, volume in enumerate(book["fulltextpath"])
+        }
+        self.max_images = max_images
+        self.images = make_images(image_size)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+        # of the fake MediaWiki
+        self.pages = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.failures = Counter()
+
+    def image_count(self, tpath):
+        count = self.volumes[tpath][2]
+        return min(count, self.max_images) if self.max_images else count
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "bytes_sent": dict(self.bytes_sent),
+                "bytes_received": dict(self.bytes_received),
+                "failures": dict(self.failures),
+            }
+
+    def serve(self, port=0):
+        standin = self
+
+        class Handler(StandinHandler):
+            pass
+
+        Handler.standin = standin
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        return self.base_url
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin = None
+
+    def log_message(self, *args):
+        pass
+
+    def endpoint(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path.startswith("/img/"):
+            return "image"
+        return path.rsplit("/", 1)[-1]
+
+    def delay_or_fail(self, endpoint):
+        standin = self.standin
+        with standin.lock:
+            standin.requests[endpoint] += 1
+            delay = standin.latency + standin.random.uniform(
+                -standin.jitter, standin.jitter
+            )
+            fail = standin.random.random() < standin.failure_rate
+            if fail:
+                standin.failures[endpoint] += 1
+        time.sleep(max(0.0, delay))
+        if fail:
+            self.reply(b"Internal Server Error", "text/plain", status=500)
+        return fail
+
+    def reply(self, body, ctype, status=200, headers=(), cut=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        sent = body if cut is None else body[:cut]
+        self.wfile.write(sent)
+        with self.standin.lock:
+            self.standin.bytes_sent[self.endpoint()] += len(sent)
+        if cut is not None:
+            self.close_connection = True
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.standin.lock:
+            self.standin.bytes_received[self.endpoint()] += len(body)
+        return body
+
+    def do_POST(self):
+        endpoint = self.endpoint()
+        body = self.read_body()
+        if self.delay_or_fail(endpoint):
+            return
+        if endpoint == "api.php":
+            return self.api(body)
+        form = dict(urllib.parse.parse_qsl(body.decode()))
+        standin = self.standin
+        if endpoint == "Pager":
+            page, size = int(form["Page"]), int(form["PageSize"])
+            rows = [
+                {
+                    "Id": book_id,
+                    "UpdateTime": standin.books[book_id]["detail"]["UpdateTime"],
+                }
+                for book_id in standin.ids[(page - 1) * size : page * size]
+            ]
+            total_pages = (len(standin.ids) + size - 1) // size
+            self.reply(
+                json.dumps({"TotalPages": total_pages, "Rows": rows}),
+                "application/json",
+            )
+        elif endpoint == "Detail_gj":
+            book = json.loads(json.dumps(standin.books[int(form["id"])]))
+            for volume in book["fulltextpath"]:
+                volume.pop("IMAGES", None)
+            self.reply(json.dumps(book, ensure_ascii=False), "application/json")
+        else:
+            self.reply(b"Not Found", "text/plain", status=404)
+
+    def do_GET(self):
+        endpoint = self.endpoint()
+        if self.delay_or_fail(endpoint):
+            return
+        split = urllib.parse.urlsplit(self.path)
+        standin = self.standin
+        if endpoint == "PicView":
+            params = dict(urllib.parse.parse_qsl(split.query))
+            tpath = params.get("path")
+            if tpath not in standin.volumes:
+                return self.reply("<html></html>", "text/html")
+            book_id, nth, _ = standin.volumes[tpath]
+            items = "".join(
+                f'<li><img src="\\img\\{book_id}\\{nth}\\{i:04d}.jpg" /></li>'
+                for i in range(standin.image_count(tpath))
+            )
+            self.reply(
+                f'<html><head><meta charset="utf-8" /></head><body>'
+                f'<ul id="galley">{items}</ul></body></html>',
+                "text/html; charset=utf-8",
+            )
+        elif endpoint == "image":
+            index = int(Path(split.path).stem)
+            image = standin.images[index % len(standin.images)]
+            start = 0
+            if self.headers.get("Range", "").startswith("bytes="):
+                start = int(self.headers["Range"][6:].split("-")[0])
+            if start >= len(image):
+                return self.reply(b"", "image/jpeg", status=416)
+            with standin.lock:
+                cut = standin.random.random() < standin.truncate_rate
+                if cut:
+                    standin.failures["truncated"] += 1
+            body = image[start:]
+            headers = [("Accept-Ranges", "bytes")]
+            if start:
+                headers.append(
+                    ("Content-Range", f"bytes {start}-{len(image) - 1}/{len(image)}")
+                )
+            self.reply(
+                body,
+                "image/jpeg",
+                status=206 if start else 200,
+                headers=headers,
+                cut=len(body) // 2 if cut else None,
+            )
+        else:
+            self.reply(b"Not Found", "text/plain", status=404)
+
+    # The parts of the MediaWiki action API that bench/fakewiki.py uses: page
+    # queries, edits and chunked uploads.
+    def api(self, body):
+        ctype = self.headers.get("Content-Type", "")
+        params = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(self.path).query))
+        if ctype.startswith("application/x-www-form-urlencoded"):
+            params.update(urllib.parse.parse_qsl(body.decode()))
+        standin = self.standin
+        action = params.get("action")
+        with standin.lock:
+            if action == "query":
+                result = {
+                    title: standin.pages.get(title)
+                    for title in params["titles"].split("|")
+                }
+            elif action == "edit":
+                standin.pages[params["title"]] = params["text"]
+                result = {"result": "Success"}
+            elif action == "upload" and "filekey" not in params:
+                # a chunk, which is the body as is
+                key = params.get("stashkey") or f"stash{len(standin.uploads)}"
+                standin.uploads[key] = standin.uploads.get(key, 0) + len(body)
+                result = {"result": "Continue", "filekey": key}
+            elif action == "upload":
+                standin.pages[params["filename"]] = params["text"]
+                result = {
+                    "result": "Success",
+                    "size": standin.uploads.pop(params["filekey"]),
+                }
+            else:
+                result = {"error": f"unknown action {action}"}
+        self.reply(json.dumps(result, ensure_ascii=False), "application/json")
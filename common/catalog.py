@@ -0,0 +1,292 @@
+import os
+import json
+import sqlite3
+import logging
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CATALOG_NAME = ".catalog.sqlite"
+
+# A compact index of the crawled books in a data directory, such as
+# crawler/data, kept in a SQLite file in the same directory.
+#
+# The field schema (`dataFields`, `channel` and the keys of `detail`), which is
+# the same for every book, is stored once. Each key of a book's `detail` gets its
+# own column in `books`, and the image lists of the volumes are split into a
+# per-volume URL prefix and per-image names. Values that SQLite has no type for,
+# i.e. booleans and lists, are recorded in `columns` so that they come back as
+# they went in.
+#
+# `conversions` keeps the results of text conversions of the crawled data, e.g.
+# to Traditional Chinese, per converter and version, so that they are done once.
+# `renders` likewise keeps what a renderer made of a book, along with a digest of
+# everything it was made from.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS schemas (
+    id INTEGER PRIMARY KEY,
+    data_fields TEXT,
+    channel TEXT,
+    detail_keys TEXT,
+    UNIQUE (data_fields, channel, detail_keys)
+);
+CREATE TABLE IF NOT EXISTS columns (name TEXT PRIMARY KEY, kind TEXT);
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    schema_id INTEGER REFERENCES schemas(id),
+    source_mtime INTEGER,
+    source_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS volumes (
+    book_id INTEGER,
+    nth INTEGER,
+    name TEXT,
+    tpath TEXT,
+    image_prefix TEXT,
+    PRIMARY KEY (book_id, nth)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS images (
+    book_id INTEGER,
+    nth INTEGER,
+    page INTEGER,
+    name TEXT,
+    PRIMARY KEY (book_id, nth, page)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS conversions (
+    converter TEXT,
+    variant TEXT,
+    source TEXT,
+    result TEXT,
+    PRIMARY KEY (converter, variant, source)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS renders (
+    renderer TEXT,
+    book_id INTEGER,
+    digest TEXT,
+    text TEXT,
+    PRIMARY KEY (renderer, book_id)
+) WITHOUT ROWID;
+"""
+
+
+def connect(data_dir):
+    db = sqlite3.connect(Path(data_dir) / CATALOG_NAME)
+    db.executescript(SCHEMA)
+    return db
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (list, dict)):
+        return "json"
+    return "plain"
+
+
+def _columns(db):
+    return dict(db.execute("SELECT name, kind FROM columns"))
+
+
+def _url_prefix(urls):
+    prefix = os.path.commonprefix(urls)
+    return prefix[: prefix.rfind("/") + 1]
+
+
+def store_book(db, book_id, book, source=None):
+    with db:
+        schema = (
+            json.dumps(book["dataFields"], ensure_ascii=False),
+            json.dumps(book["channel"], ensure_ascii=False),
+            json.dumps(list(book["detail"]), ensure_ascii=False),
+        )
+        db.execute(
+            "INSERT OR IGNORE INTO schemas (data_fields, channel, detail_keys)"
+            " VALUES (?, ?, ?)",
+            schema,
+        )
+        ((schema_id,),) = db.execute(
+            "SELECT id FROM schemas"
+            " WHERE data_fields = ? AND channel = ? AND detail_keys = ?",
+            schema,
+        )
+
+        columns = _columns(db)
+        detail = {}
+        for name, value in book["detail"].items():
+            kind = _kind(value)
+            if name not in columns:
+                db.execute(f'ALTER TABLE books ADD COLUMN "d_{name}"')
+                db.execute("INSERT INTO columns VALUES (?, ?)", (name, kind))
+                columns[name] = kind
+            elif kind != "plain" and columns[name] != kind:
+                db.execute("UPDATE columns SET kind = ? WHERE name = ?", (kind, name))
+            if kind == "json":
+                value = json.dumps(value, ensure_ascii=False)
+            detail[f'"d_{name}"'] = value
+
+        stat = os.stat(source) if source is not None else None
+        delete_book(db, book_id)
+        db.execute(
+            f"INSERT INTO books (id, schema_id, source_mtime, source_size"
+            f"{''.join(', ' + column for column in detail)})"
+            f" VALUES (?, ?, ?, ?{', ?' * len(detail)})",
+            (
+                book_id,
+                schema_id,
+                stat and stat.st_mtime_ns,
+                stat and stat.st_size,
+                *detail.values(),
+            ),
+        )
+        for nth, volume in enumerate(book["fulltextpath"], 1):
+            urls = volume.get("IMAGES", [])
+            prefix = _url_prefix(urls)
+            db.execute(
+                "INSERT INTO volumes VALUES (?, ?, ?, ?, ?)",
+                (book_id, nth, volume["name"], volume["tpath"], prefix),
+            )
+            db.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?)",
+                (
+                    (book_id, nth, page, url[len(prefix) :])
+                    for page, url in enumerate(urls, 1)
+                ),
+            )
+
+
+def delete_book(db, book_id):
+    for table, column in (
+        ("books", "id"),
+        ("volumes", "book_id"),
+        ("images", "book_id"),
+        ("renders", "book_id"),
+    ):
+        db.execute(f"DELETE FROM {table} WHERE {column} = ?", (book_id,))
+
+
+def sync(db, data_dir):
+    # re-index the books whose JSON file changed since it was indexed
+    indexed = {
+        book_id: (mtime, size)
+        for book_id, mtime, size in db.execute(
+            "SELECT id, source_mtime, source_size FROM books"
+        )
+    }
+    seen = set()
+    for path in Path(data_dir).glob("*.json"):
+        book_id = int(path.stem)
+        seen.add(book_id)
+        stat = path.stat()
+        if indexed.get(book_id) != (stat.st_mtime_ns, stat.st_size):
+            logger.debug(f"Indexing {path}")
+            with open(path) as f:
+                store_book(db, book_id, json.load(f), path)
+    with db:
+        for book_id in indexed.keys() - seen:
+            delete_book(db, book_id)
+
+
+def update_times(db):
+    # -> book id -> UpdateTime
+    return dict(db.execute('SELECT id, "d_UpdateTime" FROM books'))
+
+
+def book_ids(db):
+    return [book_id for (book_id,) in db.execute("SELECT id FROM books ORDER BY id")]
+
+
+def load_books(db, book_ids=None):
+    # -> (book id, book) in book id order, with `detail` and `fulltextpath` as
+    # in the JSON files, of all books or only of those in `book_ids`
+    columns = _columns(db)
+    detail_keys = {
+        schema_id: json.loads(keys)
+        for schema_id, keys in db.execute("SELECT id, detail_keys FROM schemas")
+    }
+    params = () if book_ids is None else tuple(book_ids)
+
+    def where(column):
+        if book_ids is None:
+            return ""
+        return f" WHERE {column} IN ({', '.join('?' * len(params))})"
+
+    selected = "".join(f', "d_{name}"' for name in columns)
+    books = db.execute(
+        f"SELECT id, schema_id{selected} FROM books{where('id')} ORDER BY id", params
+    )
+    volumes = db.execute(
+        "SELECT book_id, nth, name, tpath, image_prefix FROM volumes"
+        f"{where('book_id')} ORDER BY book_id, nth",
+        params,
+    )
+    images = db.execute(
+        f"SELECT book_id, nth, name FROM images{where('book_id')}"
+        " ORDER BY book_id, nth, page",
+        params,
+    )
+    volume = next(volumes, None)
+    image = next(images, None)
+    for book_id, schema_id, *values in books.fetchall():
+        row = dict(zip(columns, values))
+        detail = {}
+        for name in detail_keys[schema_id]:
+            value = row[name]
+            if columns[name] == "bool" and value is not None:
+                value = bool(value)
+            elif columns[name] == "json" and value is not None:
+                value = json.loads(value)
+            detail[name] = value
+        fulltextpath = []
+        while volume is not None and volume[0] == book_id:
+            _, nth, name, tpath, prefix = volume
+            urls = []
+            while image is not None and image[:2] == (book_id, nth):
+                urls.append(prefix + image[2])
+                image = next(images, None)
+            fulltextpath.append({"name": name, "tpath": tpath, "IMAGES": urls})
+            volume = next(volumes, None)
+        yield book_id, {"detail": detail, "fulltextpath": fulltextpath}
+
+
+def load_conversions(db, converter):
+    # -> (variant, source) -> result
+    return {
+        (variant, source): result
+        for variant, source, result in db.execute(
+            "SELECT variant, source, result FROM conversions WHERE converter = ?",
+            (converter,),
+        )
+    }
+
+
+def store_conversions(db, converter, conversions):
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?)",
+            (
+                (converter, variant, source, result)
+                for (variant, source), result in conversions.items()
+            ),
+        )
+
+
+def load_renders(db, renderer):
+    # -> book id -> (digest, text)
+    return {
+        book_id: (digest, text)
+        for book_id, digest, text in db.execute(
+            "SELECT book_id, digest, text FROM renders WHERE renderer = ?",
+            (renderer,),
+        )
+    }
+
+
+def store_renders(db, renderer, renders):
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?)",
+            (
+                (renderer, book_id, digest, text)
+                for book_id, (digest, text) in renders.items()
+            ),
+        )
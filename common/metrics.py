@@ -0,0 +1,178 @@
+import os
+import json
+import math
+import time
+import atexit
+import logging
+import threading
+import http.server
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "ynutcm_"
+# upper bounds in seconds, from a cached page to a slow chunked upload
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+WRITE_INTERVAL = 60
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = [*labels, *extra]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# Counters and timing histograms, keyed by name and labels, e.g.
+# observe("image_download", 0.3, host="guji.ynutcm.edu.cn").
+#
+# A registry can be written out as JSON, served in the Prometheus text format,
+# and merged with the snapshot of another, e.g. that of a worker process.
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        # key -> [count per bucket (the last one unbounded), sum, count]
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram = self.histograms[key]
+            bucket = next(
+                (i for i, bound in enumerate(BUCKETS) if seconds <= bound),
+                len(BUCKETS),
+            )
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        # without taking the lock, which a forked process may have inherited
+        # held by a thread of its parent
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "time": time.time(),
+                "buckets": BUCKETS,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": list(buckets),
+                        "sum": total,
+                        "count": count,
+                    }
+                    for (name, labels), (buckets, total, count) in sorted(
+                        self.histograms.items()
+                    )
+                ],
+            }
+
+    def merge(self, snapshot):
+        for counter in snapshot["counters"]:
+            self.count(counter["name"], counter["value"], **counter["labels"])
+        with self.lock:
+            for histogram in snapshot["histograms"]:
+                key = _key(histogram["name"], histogram["labels"])
+                if key not in self.histograms:
+                    self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+                ours = self.histograms[key]
+                ours[0] = [a + b for a, b in zip(ours[0], histogram["buckets"])]
+                ours[1] += histogram["sum"]
+                ours[2] += histogram["count"]
+
+    def write(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp_path, path)
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{PREFIX}{name}_total{_format_labels(labels)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(
+                self.histograms.items()
+            ):
+                name = f"{PREFIX}{name}_seconds"
+                cumulative = 0
+                for bound, bucket in zip((*BUCKETS, math.inf), buckets):
+                    cumulative += bucket
+                    le = "+Inf" if bound == math.inf else bound
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels, [('le', le)])}"
+                        f" {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path=None, port=None, interval=WRITE_INTERVAL):
+        # writes to `path` every `interval` seconds and on exit, and serves the
+        # Prometheus text format on `port` of localhost
+        if path:
+
+            def write_periodically():
+                while True:
+                    time.sleep(interval)
+                    self.write(path)
+
+            threading.Thread(target=write_periodically, daemon=True).start()
+            atexit.register(self.write, path)
+        if port:
+            registry = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+
+# for the whole process
+registry = Registry()
+count = registry.count
+observe = registry.observe
+timer = registry.timer
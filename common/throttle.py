@@ -0,0 +1,211 @@
+import time
+import random
+import logging
+import functools
+import threading
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+REPORT_INTERVAL = 60
+# status codes that tell the client to slow down
+THROTTLED_STATUSES = (429, 503)
+# client errors worth another try; the others would only fail again
+RETRIED_CLIENT_ERRORS = (408, 429)
+
+
+def retry_after(resp):
+    # -> seconds the server asked to wait for in Retry-After, if any
+    if resp is None or "Retry-After" not in resp.headers:
+        return None
+    value = resp.headers["Retry-After"]
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def retriable(e):
+    resp = getattr(e, "response", None)
+    if resp is None:
+        return True
+    return (
+        not 400 <= resp.status_code < 500 or resp.status_code in RETRIED_CLIENT_ERRORS
+    )
+
+
+def retry(times=3, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Retries with exponential backoff and jitter, or after as long as the server
+    # asked for with Retry-After. Every call gets `times` tries of its own, and
+    # client errors such as 404 are not retried.
+    def wrapper(fn):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            tried = 0
+            while True:
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    tried += 1
+                    if tried >= times or not retriable(e):
+                        metrics.count("failures", fn=fn.__qualname__)
+                        raise Exception(f"Failed finally after {tried} tries") from e
+                    delay = backoff(tried - 1, base, cap)
+                    asked = retry_after(getattr(e, "response", None))
+                    if asked is not None:
+                        delay = max(delay, asked)
+                    logger.warning(
+                        f"Retrying {fn.__qualname__} {tried}/{times} in {delay:.1f} s"
+                        f" due to {e!r}",
+                        exc_info=e if logger.isEnabledFor(logging.DEBUG) else None,
+                    )
+                    metrics.count("retries", fn=fn.__qualname__)
+                    time.sleep(delay)
+
+        return wrapped
+
+    return wrapper
+
+
+# A token bucket: `rate` tokens per second, up to `burst` of them saved up, or
+# as many as asked for if `rate` is None.
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # no tokens are handed out before this, e.g. after a Retry-After
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # -> seconds waited
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until and self.rate is None:
+                    return waited
+                if now >= self.paused_until:
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updated) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = self.paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = max(self.updated, self.paused_until)
+
+
+# Rate limits per host, shared by all threads of a process, with the request
+# rates logged every `report_interval` seconds.
+#
+# Hosts are limited to `rate` requests per second unless `rates` has a limit of
+# their own; None means no limit. A host that answers with Retry-After is not
+# sent anything else for as long as it asked for.
+class Throttle:
+    def __init__(self, rate=None, rates=None, burst=1, report_interval=REPORT_INTERVAL):
+        self.rate = rate
+        self.rates = rates or {}
+        self.burst = burst
+        self.report_interval = report_interval
+        self.buckets = {}
+        self.requests = Counter()
+        self.throttled = Counter()
+        self.waited = Counter()
+        self.reported = time.monotonic()
+        self.lock = threading.Lock()
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                rate = self.rates.get(host, self.rate)
+                self.buckets[host] = TokenBucket(rate or None, self.burst)
+            return self.buckets[host]
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        waited = self.bucket(host).acquire()
+        with self.lock:
+            self.requests[host] += 1
+            self.waited[host] += waited
+        metrics.count("throttle_wait_seconds", waited, host=host)
+        self.maybe_report()
+
+    def slow_down(self, url, seconds):
+        host = urlsplit(url).netloc
+        logger.info(f"{host} asked to slow down for {seconds:.1f} s")
+        with self.lock:
+            self.throttled[host] += 1
+        metrics.count("throttled", host=host)
+        self.bucket(host).pause(seconds)
+
+    def maybe_report(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.reported
+            if elapsed < self.report_interval:
+                return
+            self.reported = now
+            requests, self.requests = self.requests, Counter()
+            throttled, self.throttled = self.throttled, Counter()
+            waited, self.waited = self.waited, Counter()
+        for host, count in sorted(requests.items()):
+            logger.info(
+                f"{host}: {count / elapsed:.2f} req/s, waited {waited[host]:.1f} s,"
+                f" throttled {throttled[host]} times"
+            )
+
+
+# Sends every request of a session through a Throttle, so that only requests
+# that actually go out are counted, and not e.g. cache hits. The time until the
+# response headers are in and the bytes on the wire go to the metrics, per host.
+class ThrottledAdapter(HTTPAdapter):
+    def __init__(self, throttle, **kwargs):
+        self.throttle = throttle
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.throttle.wait(request.url)
+        host = urlsplit(request.url).netloc
+        with metrics.timer("http_request", host=host, method=request.method):
+            resp = super().send(request, **kwargs)
+        metrics.count("http_responses", host=host, status=resp.status_code)
+        if isinstance(request.body, bytes):
+            metrics.count("http_sent_bytes", len(request.body), host=host)
+        if "Content-Length" in resp.headers:
+            # as announced, which a streamed body may still fall short of
+            metrics.count(
+                "http_received_bytes", int(resp.headers["Content-Length"]), host=host
+            )
+        if resp.status_code in THROTTLED_STATUSES:
+            self.throttle.slow_down(request.url, retry_after(resp) or BACKOFF_BASE)
+        return resp
@@ -1,15 +1,30 @@
 #!/usr/bin/env python3
+import os
 import json
 import urllib.parse
 from pathlib import Path
 import logging
 import functools
 import sys
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
+import lxml.html
+from lxml import etree
 from bs4 import BeautifulSoup
 
+from httpcache import ResponseCache, CachedSession
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common import catalog, metrics
+from common.throttle import retry, Throttle, ThrottledAdapter
+
 OUTPUT_DIR = Path(__file__).parent / "data"
+CACHE_DIR = Path(__file__).parent / ".cache"
+# under OUTPUT_DIR, for the books being crawled
+PARTIAL_DIR_NAME = ".partial"
 
 USER_AGENT = "ynutcmpdbot/0.0"
 
@@ -22,104 +37,380 @@ URL_VOLUME_VIEW = "http://guji.ynutcm.edu.cn/Yngj/Data/PicView"
 CHANNEL_ID = 3123
 PAGE_SIZE = 12
 
+WORKERS = 8
+PER_HOST_LIMIT = 4
+# requests per second to the same host
+RATE_LIMIT = 10
+CACHE_TTL = 7 * 24 * 3600
+CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
 LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
 logging.basicConfig(level=LOGLEVEL)
 logger = logging.getLogger(__name__)
 
 
-def retry(times=3):
-    def wrapper(fn):
-        tried = 0
+# A pooled session shared by all worker threads, allowing at most `per_host`
+# requests in flight to the same host, and at most `rate` per second.
+class Client:
+    def __init__(self, per_host=PER_HOST_LIMIT, cache=None, rate=RATE_LIMIT):
+        self.per_host = per_host
+        self.session = CachedSession(cache) if cache else requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        self.throttle = Throttle(rate)
+        adapter = ThrottledAdapter(self.throttle, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._slots[host]
+
+    @retry(5)
+    def request(self, method, url, **kwargs):
+        with self._slot(url):
+            resp = self.session.request(method, url, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
 
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
-            while True:
-                try:
-                    return fn(*args, **kwargs)
-                except Exception as e:
-                    nonlocal tried
-                    tried += 1
-                    if tried >= times:
-                        raise Exception(f"Failed finally after {times} tries") from e
-                    logger.info(f"Retrying {fn} {tried}/{times} due to {e}", exc_info=e)
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
 
-        return wrapped
 
-    return wrapper
+client = Client()
 
 
-requests.get = retry(5)(requests.get)
-requests.post = retry(5)(requests.post)
+def pager(page, total_page="?"):
+    logger.info(f"Retrieving page {page}/{total_page}")
+    d = {
+        "PageSize": PAGE_SIZE,
+        "Page": page,
+        "SortBy": "UpdateTime",
+        "SortOrder": "desc",
+        "IsHighlight": True,
+        "query[GroupType]": "channel",
+        "query[GroupId]": CHANNEL_ID,
+        "query[isWork]": True,
+    }
+    with metrics.timer("page_fetch"):
+        resp = client.post(URL_PAGER, data=d)
+    return resp.json()
 
 
 def books(start_page=1):
     logger.info(f"Starting from page {start_page}")
     page = total_page = start_page
     while page <= total_page:
-        logger.info(f"Retrieving page {page}/{total_page}")
-        d = {
-            "PageSize": PAGE_SIZE,
-            "Page": page,
-            "SortBy": "UpdateTime",
-            "SortOrder": "desc",
-            "IsHighlight": True,
-            "query[GroupType]": "channel",
-            "query[GroupId]": CHANNEL_ID,
-            "query[isWork]": True,
-        }
-        resp = requests.post(URL_PAGER, data=d, headers={"User-Agent": USER_AGENT})
-        d = resp.json()
+        d = pager(page, total_page)
         total_page = d["TotalPages"]
         for row in d["Rows"]:
             yield row
         page += 1
 
 
+# the same as the CSS selector "#galley li img"
+GALLERY_IMAGES = etree.XPath('//*[@id="galley"]//li//img')
+
+
+def gallery_sources(content):
+    # -> src of the images in the gallery of a PicView page
+    if not content.strip():
+        return []
+    try:
+        html = lxml.html.document_fromstring(content.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError, etree.ParserError):
+        # not UTF-8 after all, with an XML encoding declaration that lxml refuses
+        # in a str, or with nothing but e.g. a comment in it, so leave it to
+        # BeautifulSoup to make out
+        html = BeautifulSoup(content, features="lxml")
+        return [img.attrs["src"] for img in html.select("#galley li img")]
+    return [img.attrib["src"] for img in GALLERY_IMAGES(html)]
+
+
 def images(number, totalnum, title, path):
     logger.info(f"Retrieving images for {path}")
     params = {"number": number, "totalnum": totalnum, "title": title, "path": path}
-    resp = requests.get(
-        URL_VOLUME_VIEW, params=params, headers={"User-Agent": USER_AGENT}
-    )
-    html = BeautifulSoup(resp.content, features="lxml")
-    for img in html.select("#galley li img"):
-        yield urllib.parse.urljoin(URL_VOLUME_VIEW, img.attrs["src"].replace("\\", "/"))
+    resp = client.get(URL_VOLUME_VIEW, params=params)
+    for src in gallery_sources(resp.content):
+        yield urllib.parse.urljoin(URL_VOLUME_VIEW, src.replace("\\", "/"))
 
 
 def book_detail(book_id):
     logger.info(f"Retrieving book {book_id}")
     d = {"id": book_id, "isView": True}
-    resp = requests.post(URL_BOOK_DETAIL, data=d, headers={"User-Agent": USER_AGENT})
+    with metrics.timer("detail_fetch"):
+        resp = client.post(URL_BOOK_DETAIL, data=d)
     d = resp.json()
     return d
 
 
-def volumes(book):
-    for vol in book["fulltextpath"]:
-        yield images(
-            book["detail"]["number"],
-            book["detail"]["totalnum"],
-            book["detail"]["title"],
-            vol["tpath"],
+def volume_images(book, vol):
+    with metrics.timer("picview_fetch"):
+        image_urls = list(
+            images(
+                book["detail"]["number"],
+                book["detail"]["totalnum"],
+                book["detail"]["title"],
+                vol["tpath"],
+            )
         )
+    metrics.count("images_listed", len(image_urls))
+    return image_urls
+
+
+def write_book(book_id, book, db):
+    path = OUTPUT_DIR / f"{book_id}.json"
+    # never leave a half-written book behind for the uploader to pick up
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(book, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    catalog.store_book(db, book_id, book, path)
+
+
+# While the volumes of a book are being crawled, the image lists are appended to
+# a JSON Lines file one volume at a time, after a first line with what tells the
+# version of the book. So nothing is lost when the crawl stops halfway through a
+# book, and only the volumes that are missing are crawled again.
+def partial_path(book_id):
+    return OUTPUT_DIR / PARTIAL_DIR_NAME / f"{book_id}.jsonl"
+
+
+def partial_key(book):
+    # not the whole detail page, whose counters such as ViewCount change with
+    # every fetch
+    return {
+        "UpdateTime": book["detail"]["UpdateTime"],
+        "tpaths": [volume["tpath"] for volume in book["fulltextpath"]],
+    }
+
+
+def start_partial(book_id, book):
+    # -> nth -> image URLs of the volumes crawled already, if `book` is the same
+    path = partial_path(book_id)
+    key = {"key": partial_key(book)}
+    records = []
+    if path.exists():
+        with open(path) as f:
+            # a line cut short by a crash is not a record
+            records = [json.loads(line) for line in f if line.endswith("\n")]
+    if records and records[0] == key:
+        return {record["nth"]: record["IMAGES"] for record in records[1:]}
+    path.parent.mkdir(exist_ok=True)
+    with open(path, "w") as f:
+        f.write(json.dumps(key, ensure_ascii=False) + "\n")
+    return {}
+
+
+def append_partial(book_id, nth, image_urls):
+    with open(partial_path(book_id), "a") as f:
+        f.write(json.dumps({"nth": nth, "IMAGES": image_urls}) + "\n")
+
+
+def known_books(db):
+    # book id -> UpdateTime of what is already in OUTPUT_DIR
+    catalog.sync(db, OUTPUT_DIR)
+    return catalog.update_times(db)
+
+
+# Requests run on a thread pool while all bookkeeping happens in the calling
+# thread: each finished request hands its result to a callback, which may submit
+# follow-up requests. So pager pages, book details and volume pages are all
+# fetched at the same time. A book is written out once its last volume is done.
+#
+# Given `known` books, the crawl is incremental instead: as the pager is sorted by
+# UpdateTime desc, pages are walked one by one until a row turns out unchanged,
+# and only new or modified books are fetched.
+class Crawler:
+    def __init__(self, db, workers=WORKERS, known=None):
+        self.db = db
+        self.workers = workers
+        self.known = known
+        self.pending = {}
+        self.added = self.changed = self.skipped = 0
+
+    def submit(self, callback, fn, *args):
+        self.pending[self.executor.submit(fn, *args)] = callback
+
+    def run(self, start_page=1):
+        logger.info(f"Starting from page {start_page}")
+        self.start_page = start_page
+        with ThreadPoolExecutor(self.workers) as self.executor:
+            self.submit(functools.partial(self.on_page, start_page), pager, start_page)
+            while self.pending:
+                done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.pending.pop(future)(future.result())
+        if self.known is not None:
+            logger.info(
+                f"Incremental crawl done: {self.added} added, {self.changed} changed,"
+                f" {self.skipped} skipped"
+            )
+
+    def unchanged(self, book_id, update_time):
+        return book_id in self.known and self.known[book_id] == update_time
+
+    def on_page(self, page, d):
+        total_page = d["TotalPages"]
+        if page == self.start_page and self.known is None:
+            for p in range(page + 1, total_page + 1):
+                self.submit(functools.partial(self.on_page, p), pager, p, total_page)
+        reached_known = False
+        for row in d["Rows"]:
+            book_id = row["Id"]
+            if self.known is not None and self.unchanged(
+                book_id, row.get("UpdateTime")
+            ):
+                logger.debug(f"Book {book_id} unchanged, skipping")
+                self.skipped += 1
+                reached_known = True
+                continue
+            self.submit(functools.partial(self.on_book, book_id), book_detail, book_id)
+        if self.known is not None and page < total_page:
+            if reached_known:
+                logger.info(f"Reached unchanged books on page {page}, stopping")
+            else:
+                p = page + 1
+                self.submit(functools.partial(self.on_page, p), pager, p, total_page)
+
+    def on_book(self, book_id, book):
+        if self.known is not None:
+            # in case the pager row did not tell
+            if self.unchanged(book_id, book["detail"]["UpdateTime"]):
+                logger.debug(f"Book {book_id} unchanged, skipping")
+                self.skipped += 1
+                return
+        if not book["fulltextpath"]:
+            self.write_book(book_id, book)
+            return
+        done = start_partial(book_id, book)
+        if done:
+            logger.info(
+                f"Resuming book {book_id} with {len(done)}"
+                f"/{len(book['fulltextpath'])} volumes done"
+            )
+        remaining = [len(book["fulltextpath"]) - len(done)]
+        if not remaining[0]:
+            self.finish_book(book_id, book)
+        for nth, entry in enumerate(book["fulltextpath"]):
+            if nth in done:
+                continue
+            self.submit(
+                functools.partial(self.on_volume, book_id, book, nth, remaining),
+                volume_images,
+                book,
+                entry,
+            )
+
+    def on_volume(self, book_id, book, nth, remaining, image_urls):
+        if not image_urls:
+            logger.warning(f"No image found in a volume of {book_id}")
+            metrics.count("empty_volumes")
+        append_partial(book_id, nth, image_urls)
+        remaining[0] -= 1
+        if remaining[0] == 0:
+            self.finish_book(book_id, book)
+
+    def finish_book(self, book_id, book):
+        # the image lists are only read back now, so that they do not pile up in
+        # memory for all the books in flight
+        images = start_partial(book_id, book)
+        for nth, entry in enumerate(book["fulltextpath"]):
+            entry["IMAGES"] = images[nth]
+        self.write_book(book_id, book)
+        partial_path(book_id).unlink()
+
+    def write_book(self, book_id, book):
+        if self.known is not None:
+            if book_id in self.known:
+                logger.info(f"Book {book_id} changed")
+                self.changed += 1
+            else:
+                logger.info(f"Book {book_id} added")
+                self.added += 1
+        write_book(book_id, book, self.db)
+        metrics.count("books_written")
 
 
 def main():
-    start_page = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("start_page", nargs="?", type=int, default=1)
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of requests to run concurrently",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=PER_HOST_LIMIT,
+        help="maximum number of requests in flight to the same host",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=RATE_LIMIT,
+        help="maximum number of requests per second to the same host (0: no limit)",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="only fetch books that are new or updated since the last crawl",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not use the response cache"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=CACHE_TTL,
+        help="seconds for which a cached response is used without revalidation",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_MAX_SIZE,
+        help="size in bytes above which cached responses are evicted",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="write timings and counters as JSON to this file, every minute and at exit",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve timings and counters in the Prometheus text format on this port",
+    )
+    args = parser.parse_args()
+    metrics.registry.export(args.metrics_file, args.metrics_port)
+
+    cache = None
+    if not args.no_cache:
+        # an incremental crawl is after changes, so always revalidate
+        ttl = 0 if args.incremental else args.cache_ttl
+        cache = ResponseCache(CACHE_DIR, ttl, args.cache_size)
+    global client
+    client = Client(args.per_host, cache, args.rate or None)
 
     if not OUTPUT_DIR.exists():
         logger.warn(f"Output directory {OUTPUT_DIR} does not exist, creating...")
         OUTPUT_DIR.mkdir()
 
-    for book in books():
-        book_id = book["Id"]
-        book = book_detail(book_id)
-        for entry, imageset in zip(book["fulltextpath"], volumes(book)):
-            entry["IMAGES"] = list(imageset)
-            if not entry["IMAGES"]:
-                logger.warning(f"No image found in a volume of {book_id}")
-        with open(OUTPUT_DIR / f"{book_id}.json", "w") as f:
-            json.dump(book, f, indent=2, ensure_ascii=False)
+    # the JSON files stay the source of truth, the catalog is an index of them
+    db = catalog.connect(OUTPUT_DIR)
+    known = known_books(db) if args.incremental else None
+    Crawler(db, args.workers, known).run(args.start_page)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+# not meaningful once the body has been decoded and stored
+DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+# An on-disk cache of successful responses, keyed by method, URL and body.
+#
+# Entries younger than `ttl` are served without touching the network. Older
+# entries are revalidated with If-None-Match/If-Modified-Since when the server
+# gave an ETag or Last-Modified, and refetched otherwise. Once the bodies add up
+# to more than `max_size` bytes, the least recently used entries are evicted.
+class ResponseCache:
+    def __init__(self, directory, ttl, max_size):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(path.stat().st_size for path in self.directory.glob("*/*"))
+        if self._size > self.max_size:
+            self._evict()
+
+    @staticmethod
+    def key(prepared):
+        h = hashlib.sha256()
+        h.update(prepared.method.encode())
+        h.update(b"\0")
+        h.update(prepared.url.encode())
+        h.update(b"\0")
+        body = prepared.body or b""
+        h.update(body.encode() if isinstance(body, str) else body)
+        return h.hexdigest()
+
+    def _paths(self, key):
+        d = self.directory / key[:2]
+        return d / f"{key}.json", d / f"{key}.body"
+
+    def load(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(meta_path)  # for LRU eviction
+        return meta, body
+
+    def store(self, key, meta, body):
+        meta_path, body_path = self._paths(key)
+        meta_path.parent.mkdir(exist_ok=True)
+        old_size = sum(p.stat().st_size for p in (meta_path, body_path) if p.exists())
+        # the body goes first, so a meta file always has a complete body behind it
+        for path, content in (
+            (body_path, body),
+            (meta_path, json.dumps(meta).encode()),
+        ):
+            tmp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        new_size = sum(p.stat().st_size for p in (meta_path, body_path))
+        with self._lock:
+            self._size += new_size - old_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def touch(self, key, meta):
+        meta_path, _ = self._paths(key)
+        tmp_path = meta_path.with_name(f"{meta_path.name}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+
+    def _evict(self):
+        # evict down to 90% so that not every store has to scan the directory
+        target = self.max_size * 0.9
+        entries = sorted(
+            self.directory.glob("*/*.json"), key=lambda path: path.stat().st_mtime
+        )
+        for meta_path in entries:
+            if self._size <= target:
+                break
+            body_path = meta_path.with_suffix(".body")
+            for path in (meta_path, body_path):
+                try:
+                    self._size -= path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        logger.debug(f"Evicted cache down to {self._size} B")
+
+
+class CachedSession(requests.Session):
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+    def request(self, method, url, params=None, data=None, max_age=None, **kwargs):
+        if max_age is None:
+            max_age = self.cache.ttl
+        prepared = requests.Request(method, url, params=params, data=data).prepare()
+        key = self.cache.key(prepared)
+        entry = self.cache.load(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if entry is not None:
+            meta, body = entry
+            if time.time() - meta["stored_at"] < max_age:
+                logger.debug(f"Cache hit for {prepared.url}")
+                return self._from_cache(prepared, meta, body)
+            if "etag" in meta["headers"]:
+                headers["If-None-Match"] = meta["headers"]["etag"]
+            if "last-modified" in meta["headers"]:
+                headers["If-Modified-Since"] = meta["headers"]["last-modified"]
+        resp = super().request(
+            method, url, params=params, data=data, headers=headers, **kwargs
+        )
+        if resp.status_code == 304 and entry is not None:
+            logger.debug(f"Cache revalidated for {prepared.url}")
+            meta["stored_at"] = time.time()
+            self.cache.touch(key, meta)
+            return self._from_cache(prepared, meta, body)
+        if resp.status_code == 200:
+            meta = {
+                "url": resp.url,
+                "status": resp.status_code,
+                "headers": {
+                    k.lower(): v
+                    for k, v in resp.headers.items()
+                    if k.lower() not in DROPPED_HEADERS
+                },
+                "stored_at": time.time(),
+            }
+            self.cache.store(key, meta, resp.content)
+        return resp
+
+    @staticmethod
+    def _from_cache(prepared, meta, body):
+        resp = requests.Response()
+        resp.status_code = meta["status"]
+        resp.headers = CaseInsensitiveDict(meta["headers"])
+        resp.url = meta["url"]
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp.request = prepared
+        resp._content = body
+        resp.from_cache = True
+        return resp
@@ -0,0 +1,31 @@
+import sys
+import shutil
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# the crawler, the uploader and the benchmark are run as scripts from their own
+# directories, so their modules import each other by bare name
+for path in (ROOT, ROOT / "crawler", ROOT / "uploader", ROOT / "bench"):
+    sys.path.insert(0, str(path))
+
+DATA_DIR = ROOT / "crawler" / "data"
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # a copy of a few crawled books
+    directory = tmp_path / "data"
+    directory.mkdir()
+    for path in sorted(DATA_DIR.glob("*.json"))[:8]:
+        shutil.copy(path, directory)
+    return directory
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    # retries right away, still waiting for as long as Retry-After asks
+    from common import throttle
+
+    monkeypatch.setattr(throttle, "backoff", lambda *args: 0)
@@ -0,0 +1,56 @@
+import pytest
+
+from blobstore import BlobStore, file_digest
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(tmp_path / "blobs", 2500)
+
+
+def blob(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return path
+
+
+def test_round_trip(store, tmp_path):
+    digest = store.put("url:a", blob(tmp_path, "a.jpg", b"a" * 1000))
+    # the same content under another key is stored once
+    assert store.put("url:b", blob(tmp_path, "b.jpg", b"a" * 1000)) == digest
+    assert len(list((store.directory / "objects").glob("*/*"))) == 1
+    for key in ("url:a", "url:b"):
+        dest = tmp_path / "out.jpg"
+        assert store.get(key, dest)
+        assert dest.read_bytes() == b"a" * 1000
+    assert not store.get("url:c", tmp_path / "out.jpg")
+
+
+def test_corrupted_blobs_are_dropped(store, tmp_path):
+    digest = store.put("url:a", blob(tmp_path, "a.jpg", b"a" * 1000))
+    # flipped on disk since
+    with open(store.path(digest), "r+b") as f:
+        f.write(b"b")
+    dest = tmp_path / "out.jpg"
+    assert not store.get("url:a", dest)
+    assert not dest.exists()
+    assert not store.path(digest).exists()
+    assert not store.get("url:a", dest)
+
+
+def test_missing_blobs_are_dropped(store, tmp_path):
+    digest = store.put("url:a", blob(tmp_path, "a.jpg", b"a" * 1000))
+    store.path(digest).unlink()
+    assert not store.get("url:a", tmp_path / "out.jpg")
+    assert store.db.execute("SELECT COUNT(*) FROM refs").fetchone() == (0,)
+
+
+def test_least_recently_used_are_evicted(store, tmp_path):
+    store.put("url:a", blob(tmp_path, "a.jpg", b"a" * 1000))
+    store.put("url:b", blob(tmp_path, "b.jpg", b"b" * 1000))
+    assert store.get("url:a", tmp_path / "out.jpg")
+    # past the 2500 bytes of the store
+    store.put("url:c", blob(tmp_path, "c.jpg", b"c" * 1000))
+    kept = [key for key in "abc" if store.get(f"url:{key}", tmp_path / "out.jpg")]
+    assert kept == ["a", "c"]
+    assert file_digest(tmp_path / "out.jpg") == file_digest(tmp_path / "c.jpg")
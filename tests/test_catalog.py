@@ -0,0 +1,57 @@
+import json
+
+from common import catalog
+
+
+def load_json(path):
+    with open(path) as f:
+        book = json.load(f)
+    return {"detail": book["detail"], "fulltextpath": book["fulltextpath"]}
+
+
+def test_round_trip(data_dir):
+    db = catalog.connect(data_dir)
+    catalog.sync(db, data_dir)
+    paths = sorted(data_dir.glob("*.json"))
+    assert catalog.book_ids(db) == [int(path.stem) for path in paths]
+    books = dict(catalog.load_books(db))
+    for path in paths:
+        assert books[int(path.stem)] == load_json(path)
+    some = [int(path.stem) for path in paths[1::3]]
+    assert [book_id for book_id, _ in catalog.load_books(db, some)] == some
+
+
+def test_sync_follows_the_files(data_dir):
+    db = catalog.connect(data_dir)
+    catalog.sync(db, data_dir)
+    changed, removed, *_ = sorted(data_dir.glob("*.json"))
+    with open(changed) as f:
+        book = json.load(f)
+    book["detail"]["UpdateTime"] = "2099-01-01T00:00:00"
+    book["fulltextpath"] = book["fulltextpath"][:1]
+    with open(changed, "w") as f:
+        json.dump(book, f, ensure_ascii=False)
+    removed.unlink()
+
+    # a fresh connection, as the next run would have
+    db = catalog.connect(data_dir)
+    catalog.sync(db, data_dir)
+    assert int(removed.stem) not in catalog.book_ids(db)
+    assert catalog.update_times(db)[int(changed.stem)] == "2099-01-01T00:00:00"
+    ((_, loaded),) = catalog.load_books(db, [int(changed.stem)])
+    assert loaded == load_json(changed)
+
+
+def test_conversions(tmp_path):
+    db = catalog.connect(tmp_path)
+    catalog.store_conversions(db, "zhconv 1", {("zh-hant", "医"): "醫"})
+    assert catalog.load_conversions(db, "zhconv 1") == {("zh-hant", "医"): "醫"}
+    assert catalog.load_conversions(db, "zhconv 2") == {}
+
+
+def test_renders(tmp_path):
+    db = catalog.connect(tmp_path)
+    catalog.store_renders(db, "gentable 1", {7030: ("digest", "* 《書》")})
+    catalog.store_renders(db, "gentable 1", {7030: ("changed", "* 《書》 著")})
+    assert catalog.load_renders(db, "gentable 1") == {7030: ("changed", "* 《書》 著")}
+    assert catalog.load_renders(db, "gentable 2") == {}
@@ -0,0 +1,131 @@
+import json
+import time
+
+import pytest
+
+import crawl
+from common import catalog
+from standin import Standin
+from stages import rebase
+
+LATENCY = 0.05
+
+
+@pytest.fixture
+def standin(data_dir, request):
+    options = getattr(request, "param", {})
+    standin = Standin(data_dir, max_images=5, image_size=(16, 16), **options)
+    standin.serve()
+    yield standin
+    standin.shutdown()
+
+
+@pytest.fixture
+def output_dir(tmp_path, standin, monkeypatch):
+    # the crawler pointed at the stand-in, writing to a directory of its own
+    directory = tmp_path / "crawled"
+    directory.mkdir()
+    for name in ("URL_PAGER", "URL_BOOK_DETAIL", "URL_VOLUME_VIEW"):
+        monkeypatch.setattr(crawl, name, rebase(getattr(crawl, name), standin.base_url))
+    monkeypatch.setattr(crawl, "OUTPUT_DIR", directory)
+    monkeypatch.setattr(crawl, "client", crawl.Client(per_host=8, rate=None))
+    return directory
+
+
+def check_crawled(standin, output_dir):
+    assert sorted(int(path.stem) for path in output_dir.glob("*.json")) == sorted(
+        standin.books
+    )
+    for book_id, book in standin.books.items():
+        with open(output_dir / f"{book_id}.json") as f:
+            crawled = json.load(f)
+        assert crawled["detail"] == book["detail"]
+        assert len(crawled["fulltextpath"]) == len(book["fulltextpath"])
+        for nth, volume in enumerate(book["fulltextpath"]):
+            assert crawled["fulltextpath"][nth]["IMAGES"] == [
+                f"{standin.base_url}/img/{book_id}/{nth}/{i:04d}.jpg"
+                for i in range(standin.image_count(volume["tpath"]))
+            ]
+    # nothing left half done
+    assert not list((output_dir / crawl.PARTIAL_DIR_NAME).glob("*"))
+
+
+@pytest.mark.parametrize("standin", [{"latency": LATENCY}], indirect=True)
+def test_crawl_concurrently(standin, output_dir):
+    db = catalog.connect(output_dir)
+    start = time.monotonic()
+    crawl.Crawler(db, workers=8).run()
+    elapsed = time.monotonic() - start
+    check_crawled(standin, output_dir)
+    requests = sum(standin.stats()["requests"].values())
+    # one at a time, it would take at least LATENCY per request
+    assert elapsed < requests * LATENCY / 2
+    assert sorted(catalog.book_ids(db)) == sorted(standin.books)
+
+
+@pytest.mark.parametrize("standin", [{"failure_rate": 0.2, "seed": 1}], indirect=True)
+def test_crawl_retries_failures(standin, output_dir, no_backoff):
+    crawl.Crawler(catalog.connect(output_dir), workers=4).run()
+    assert standin.stats()["failures"]
+    check_crawled(standin, output_dir)
+
+
+def test_incremental_crawl_skips_unchanged(standin, output_dir):
+    db = catalog.connect(output_dir)
+    crawl.Crawler(db).run()
+    details = standin.stats()["requests"]["Detail_gj"]
+
+    crawler = crawl.Crawler(db, known=crawl.known_books(db))
+    crawler.run()
+    assert standin.stats()["requests"]["Detail_gj"] == details
+    assert (crawler.added, crawler.changed) == (0, 0)
+    assert crawler.skipped
+
+    # the most recently updated book comes first in the pager
+    newest = standin.books[standin.ids[0]]
+    newest["detail"]["UpdateTime"] = "2099-01-01T00:00:00"
+    crawler = crawl.Crawler(db, known=crawl.known_books(db))
+    crawler.run()
+    assert standin.stats()["requests"]["Detail_gj"] == details + 1
+    assert (crawler.added, crawler.changed) == (0, 1)
+    check_crawled(standin, output_dir)
+
+
+def test_crawl_resumes_books(standin, output_dir, monkeypatch):
+    book_id = next(
+        book_id
+        for book_id, book in standin.books.items()
+        if len(book["fulltextpath"]) >= 3
+    )
+    last = len(standin.books[book_id]["fulltextpath"]) - 1
+    partial = crawl.OUTPUT_DIR / crawl.PARTIAL_DIR_NAME / f"{book_id}.jsonl"
+    volume_images = crawl.volume_images
+    fetched = []
+
+    def interrupted(book, vol):
+        nth = book["fulltextpath"].index(vol)
+        if book["detail"]["Id"] == book_id and nth == last:
+            # once the other volumes are in, so that only this one is missing
+            deadline = time.monotonic() + 10
+            while len(partial.read_text().splitlines()) < last + 1:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            raise ConnectionError("interrupted")
+        return volume_images(book, vol)
+
+    def counted(book, vol):
+        fetched.append((book["detail"]["Id"], book["fulltextpath"].index(vol)))
+        return volume_images(book, vol)
+
+    db = catalog.connect(output_dir)
+    monkeypatch.setattr(crawl, "volume_images", interrupted)
+    with pytest.raises(ConnectionError):
+        crawl.Crawler(db, workers=2).run()
+    assert not (output_dir / f"{book_id}.json").exists()
+
+    # the counters of the detail page change with every view
+    standin.books[book_id]["detail"]["ViewCount"] += 1
+    monkeypatch.setattr(crawl, "volume_images", counted)
+    crawl.Crawler(db, workers=2).run()
+    assert [nth for fetched_id, nth in fetched if fetched_id == book_id] == [last]
+    check_crawled(standin, output_dir)
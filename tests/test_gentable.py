@@ -0,0 +1,53 @@
+import json
+
+import gentable
+from common import catalog
+
+CONFIG = {"template": "YNUTCM", "booknavi": "YNUTCM-navi", "name": "batch"}
+
+
+def count_renders(monkeypatch):
+    rendered = []
+    render_section = gentable.render_section
+
+    def counted(book):
+        rendered.append(book["id"])
+        return render_section(book)
+
+    monkeypatch.setattr(gentable, "render_section", counted)
+    return rendered
+
+
+def test_render_table_caches(data_dir, monkeypatch):
+    rendered = count_renders(monkeypatch)
+    sections = gentable.render_table(CONFIG, data_dir, workers=1)
+    paths = sorted(data_dir.glob("*.json"))
+    assert len(sections) == len(paths)
+    assert sorted(rendered) == [int(path.stem) for path in paths]
+
+    rendered.clear()
+    assert gentable.render_table(CONFIG, data_dir, workers=1) == sections
+    assert rendered == []
+
+    changed = paths[2]
+    with open(changed) as f:
+        book = json.load(f)
+    book["detail"]["title"] = "新書名"
+    with open(changed, "w") as f:
+        json.dump(book, f, ensure_ascii=False)
+    again = gentable.render_table(CONFIG, data_dir, workers=1)
+    assert rendered == [int(changed.stem)]
+    assert again[2].startswith("* 《新書名》")
+    assert again[:2] + again[3:] == sections[:2] + sections[3:]
+
+    # the sections depend on the config too
+    rendered.clear()
+    gentable.render_table({**CONFIG, "name": "another"}, data_dir, workers=1)
+    assert len(rendered) == len(paths)
+
+
+def test_render_table_in_parallel(data_dir, monkeypatch):
+    serial = gentable.render_table(CONFIG, data_dir, workers=1)
+    (data_dir / catalog.CATALOG_NAME).unlink()
+    monkeypatch.setattr(gentable, "CHUNK_BOOKS", 3)
+    assert gentable.render_table(CONFIG, data_dir, workers=2) == serial
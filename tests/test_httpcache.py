@@ -0,0 +1,100 @@
+import os
+import threading
+import http.server
+
+import pytest
+
+from httpcache import ResponseCache, CachedSession
+
+
+# Serves a body with an ETag, unless the path asks for none, and answers 304
+# to If-None-Match with the current ETag.
+class ETagHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    body = b"first"
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.hits.append((self.path, self.headers.get("If-None-Match")))
+        etag = f'"{len(self.body)}"'
+        if self.path != "/untagged" and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path != "/untagged":
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+@pytest.fixture
+def server():
+    ETagHandler.body, ETagHandler.hits = b"first", []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ETagHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_fresh_entries_are_served_from_the_cache(server, tmp_path):
+    session = CachedSession(ResponseCache(tmp_path, ttl=60, max_size=1 << 20))
+    assert session.get(f"{server}/page").content == b"first"
+    ETagHandler.body = b"second"
+    resp = session.get(f"{server}/page")
+    assert resp.content == b"first"
+    assert resp.from_cache
+    assert len(ETagHandler.hits) == 1
+    # unless asked for something fresher
+    assert session.get(f"{server}/page", max_age=0).content == b"second"
+    # the cache is on disk, for the next run
+    session = CachedSession(ResponseCache(tmp_path, ttl=60, max_size=1 << 20))
+    assert session.get(f"{server}/page").content == b"second"
+    assert len(ETagHandler.hits) == 2
+
+
+def test_stale_entries_are_revalidated(server, tmp_path):
+    session = CachedSession(ResponseCache(tmp_path, ttl=0, max_size=1 << 20))
+    session.get(f"{server}/page")
+    resp = session.get(f"{server}/page")
+    assert resp.status_code == 200
+    assert resp.content == b"first"
+    assert resp.from_cache
+    assert ETagHandler.hits == [("/page", None), ("/page", '"5"')]
+
+    ETagHandler.body = b"changed"
+    resp = session.get(f"{server}/page")
+    assert resp.content == b"changed"
+    assert not hasattr(resp, "from_cache")
+    assert session.get(f"{server}/page").content == b"changed"
+    assert ETagHandler.hits[-1] == ("/page", '"7"')
+
+
+def test_stale_entries_without_validators_are_refetched(server, tmp_path):
+    session = CachedSession(ResponseCache(tmp_path, ttl=0, max_size=1 << 20))
+    session.get(f"{server}/untagged")
+    ETagHandler.body = b"second"
+    assert session.get(f"{server}/untagged").content == b"second"
+    assert ETagHandler.hits == [("/untagged", None), ("/untagged", None)]
+
+
+def test_eviction(tmp_path):
+    cache = ResponseCache(tmp_path, ttl=60, max_size=3500)
+    for n in range(3):
+        cache.store(str(n) * 64, {"n": n}, b"x" * 1000)
+        # older to newer, whatever the resolution of the clock
+        meta_path, _ = cache._paths(str(n) * 64)
+        os.utime(meta_path, (n, n))
+    # used since, so no longer the least recently used
+    assert cache.load("0" * 64) == ({"n": 0}, b"x" * 1000)
+    cache.store("3" * 64, {"n": 3}, b"x" * 1000)
+    assert [n for n in range(4) if cache.load(str(n) * 64)] == [0, 2, 3]
+
+    # down to the size it is opened with
+    cache = ResponseCache(tmp_path, ttl=60, max_size=1500)
+    assert len([n for n in range(4) if cache.load(str(n) * 64)]) == 1
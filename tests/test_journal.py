@@ -0,0 +1,132 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from journal import (
+    Journal,
+    PLANNED,
+    DOWNLOADED,
+    UPLOADED,
+    FAILED,
+    SKIPPED,
+)
+
+VOLUMES = [
+    ("a-1.pdf", "a.json", 0),
+    ("a-2.pdf", "a.json", 1),
+    ("b.pdf", "b.json", 0),
+    ("c.pdf", "c.json", 0),
+]
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = Journal(tmp_path / "journal.sqlite")
+    journal.plan(VOLUMES)
+    return journal
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_plan_keeps_states(journal, tmp_path):
+    journal.record("a-1.pdf", UPLOADED)
+    # planned again by the next run, from a journal opened afresh
+    journal = Journal(tmp_path / "journal.sqlite")
+    journal.plan(VOLUMES + [("d.pdf", "d.json", 0)])
+    states = journal.states()
+    assert states["a-1.pdf"] == UPLOADED
+    assert states["d.pdf"] == PLANNED
+
+
+def test_plan_refuses_shared_file_names(tmp_path):
+    journal = Journal(tmp_path / "journal.sqlite")
+    with pytest.raises(ValueError, match="a.pdf"):
+        journal.plan([("a.pdf", "a.json", 0), ("a.pdf", "b.json", 0)])
+    assert journal.states() == {}
+
+
+def test_record(journal):
+    journal.record("a-1.pdf", DOWNLOADED)
+    journal.record("a-1.pdf", FAILED, "timeout")
+    journal.record("a-1.pdf", FAILED, "timeout again")
+    journal.record("b.pdf", SKIPPED, "no images")
+    journal.record("c.pdf", UPLOADED)
+    assert journal.failures() == [("a-1.pdf", "timeout again", 2)]
+    assert journal.summary() == {FAILED: 1, SKIPPED: 1, UPLOADED: 1, PLANNED: 1}
+
+
+def test_claim_whole_books_once(journal):
+    books = iter(["a.json", "b.json", "c.json"])
+    assert journal.claim(books, "host/1", 2) == ["a.json", "b.json"]
+    # consumed only as far as needed
+    assert list(books) == ["c.json"]
+    assert journal.claim(iter(["a.json", "c.json"]), "host/2", 2) == ["c.json"]
+    # a claim is held until released, but the owner may claim again
+    assert journal.claim(iter(["a.json"]), "host/1", 1) == ["a.json"]
+    owners = dict(journal.db.execute("SELECT filename, owner FROM volumes"))
+    assert owners == {
+        "a-1.pdf": "host/1",
+        "a-2.pdf": "host/1",
+        "b.pdf": "host/1",
+        "c.pdf": "host/2",
+    }
+
+
+def test_release_stale(journal):
+    host = socket.gethostname()
+    dead = f"{host}/{dead_pid()}"
+    alive = f"{host}/{os.getpid()}"
+    elsewhere = f"{host}.elsewhere/{dead_pid()}"
+    journal.claim(iter(["a.json"]), dead, 1)
+    journal.claim(iter(["b.json"]), alive, 1)
+    journal.claim(iter(["c.json"]), elsewhere, 1)
+    journal.release_stale()
+    # only the claims of gone processes on this host are released
+    assert journal.claim(iter(["a.json", "b.json", "c.json"]), "next/1", 3) == [
+        "a.json"
+    ]
+
+
+def test_release(journal):
+    journal.claim(iter(["a.json", "b.json"]), "host/1", 2)
+    journal.claim(iter(["c.json"]), "host/2", 1)
+    assert journal.claims() == {"host/1": 2, "host/2": 1}
+    journal.release("host/1")
+    assert journal.claims() == {"host/2": 1}
+    assert journal.claim(iter(["a.json", "b.json", "c.json"]), "host/3", 3) == [
+        "a.json",
+        "b.json",
+    ]
+
+
+def test_claim_since(journal):
+    started = time.time()
+    # done with and released by another worker of the same run
+    journal.claim(iter(["a.json"]), "host/1", 1, started)
+    journal.record("a-1.pdf", UPLOADED)
+    journal.release("host/1")
+    assert journal.claim(iter(["a.json", "b.json"]), "host/2", 2, started) == ["b.json"]
+    # but taken up again by the next run
+    assert journal.claim(iter(["a.json"]), "host/3", 1, time.time()) == ["a.json"]
+
+
+def test_record_file(journal):
+    journal.record_file("c.pdf", "da39a3ee", 123)
+    journal.record("c.pdf", UPLOADED)
+    journal.record_file("b.pdf", "5ba93c9d", 456)
+    journal.record_file("b.pdf", "0b9c2625", 789)
+    assert journal.files() == {
+        "b.pdf": ("0b9c2625", 789),
+        "c.pdf": ("da39a3ee", 123),
+    }
+    # kept when planned again
+    journal.plan(VOLUMES)
+    assert journal.files()["c.pdf"] == ("da39a3ee", 123)
@@ -0,0 +1,52 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from pdfstream import PdfWriter
+
+pypdf = pytest.importorskip("pypdf")
+
+
+def jpeg(path, mode, size, dpi=None, orientation=None):
+    img = Image.new(mode, size)
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    img.save(path, format="JPEG", dpi=dpi or (72, 72), exif=exif)
+    return path
+
+
+def test_pages(tmp_path):
+    output = BytesIO()
+    pdf = PdfWriter(output)
+    pdf.add_jpeg(jpeg(tmp_path / "rgb.jpg", "RGB", (300, 600), dpi=(300, 300)))
+    pdf.add_jpeg(jpeg(tmp_path / "gray.jpg", "L", (144, 72), orientation=6))
+    pdf.add_jpeg(jpeg(tmp_path / "cmyk.jpg", "CMYK", (72, 72)))
+    # not a JPEG, so re-encoded
+    png = tmp_path / "page.png"
+    Image.new("RGB", (72, 72)).save(png)
+    pdf.add_jpeg(png)
+    pdf.close()
+
+    reader = pypdf.PdfReader(BytesIO(output.getvalue()), strict=True)
+    assert len(reader.pages) == 4
+    rgb, gray, cmyk, png_page = reader.pages
+    # sized after the DPI of the image, as img2pdf does
+    assert [float(v) for v in rgb.mediabox[2:]] == [72, 144]
+    assert [float(v) for v in gray.mediabox[2:]] == [144, 72]
+    assert gray.get("/Rotate") == 90
+    images = [page.images[0].image for page in (rgb, gray, cmyk, png_page)]
+    assert [image.mode for image in images] == ["RGB", "L", "CMYK", "RGB"]
+    assert [image.size for image in images] == [
+        (300, 600),
+        (144, 72),
+        (72, 72),
+        (72, 72),
+    ]
+
+
+def test_empty(tmp_path):
+    output = BytesIO()
+    PdfWriter(output).close()
+    assert len(pypdf.PdfReader(BytesIO(output.getvalue()), strict=True).pages) == 0
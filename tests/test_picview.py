@@ -0,0 +1,22 @@
+from pathlib import Path
+
+import pytest
+
+import crawl
+import picview
+
+FIXTURES = sorted(Path(picview.FIXTURES_DIR).glob("*.html"))
+
+
+@pytest.mark.filterwarnings("ignore")
+@pytest.mark.parametrize("path", FIXTURES, ids=lambda path: path.name)
+def test_gallery_sources(path):
+    # as the BeautifulSoup parsing it replaced has it
+    content = path.read_bytes()
+    assert crawl.gallery_sources(content) == picview.soup_sources(content)
+
+
+@pytest.mark.filterwarnings("ignore")
+def test_empty_pages():
+    for content in (b"", b"  \n", b"<!-- x -->", b'<?xml version="1.0"?>'):
+        assert crawl.gallery_sources(content) == []
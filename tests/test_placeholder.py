@@ -0,0 +1,36 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import placeholder
+from pdfstream import PdfWriter
+
+pypdf = pytest.importorskip("pypdf")
+
+URL = "http://example.org/0001.jpg"
+
+
+def test_vector_page():
+    output = BytesIO()
+    pdf = PdfWriter(output)
+    placeholder.add_vector_page(pdf, URL, "1")
+    pdf.close()
+
+    reader = pypdf.PdfReader(BytesIO(output.getvalue()), strict=True)
+    (page,) = reader.pages
+    text = page.extract_text()
+    assert "The page 1 links to an broken url:" in text
+    assert URL in text
+    assert "/F1" in page["/Resources"]["/Font"]
+    # nothing rasterized
+    assert not page.images
+
+
+def test_raster_page():
+    img = Image.open(BytesIO(placeholder.render_jpeg(URL, "1")))
+    assert img.format == "JPEG"
+    # the lines and the QR code below them
+    width, height = img.size
+    assert width > placeholder.line_width(URL)
+    assert height > len(placeholder.qr_matrix(URL)) * placeholder.QR_BOX_SIZE
@@ -0,0 +1,40 @@
+import plan
+from common import catalog
+
+
+def test_converter_caches(tmp_path, monkeypatch):
+    calls = []
+
+    def counted(s, variant):
+        calls.append((variant, s))
+        return f"{variant}:{s}"
+
+    monkeypatch.setattr(plan, "zhconv_", counted)
+    zhconv = plan.Converter()
+    assert zhconv("医书", "zh-hant") == "zh-hant:医书"
+    assert zhconv("医书", "zh-hant") == "zh-hant:医书"
+    assert zhconv("医书", "zh-hans") == "zh-hans:医书"
+    assert zhconv(None, "zh-hant") is None
+    assert zhconv(7, "zh-hant") == 7
+    assert calls == [("zh-hant", "医书"), ("zh-hans", "医书")]
+
+    # kept in the catalog for the next run
+    db = catalog.connect(tmp_path)
+    zhconv.save(db)
+    assert zhconv.new == {}
+    zhconv = plan.Converter()
+    zhconv.load(db)
+    assert zhconv("医书", "zh-hans") == "zh-hans:医书"
+    assert zhconv("医", "zh-hans") == "zh-hans:医"
+    assert calls[2:] == [("zh-hans", "医")]
+    assert zhconv.new == {("zh-hans", "医"): "zh-hans:医"}
+
+
+def test_collisions():
+    manifest = [
+        {"volumes": [{"filename": "a.pdf"}, {"filename": "b.pdf"}]},
+        {"volumes": [{"filename": "c.pdf"}, {"filename": "b.pdf"}]},
+        {"volumes": [{"filename": "a.pdf"}]},
+    ]
+    assert plan.collisions(manifest) == ["a.pdf", "b.pdf"]
+    assert plan.collisions(manifest[:1]) == []
@@ -0,0 +1,139 @@
+import time
+import threading
+import http.server
+from email.utils import formatdate
+
+import pytest
+import requests
+
+from common import throttle
+from common.throttle import retry, retry_after, TokenBucket, Throttle, ThrottledAdapter
+
+
+def http_error(status, headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.headers.update(headers or {})
+    return requests.HTTPError(f"{status}", response=resp)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(throttle.time, "sleep", slept.append)
+    return slept
+
+
+def test_retry_after():
+    assert retry_after(http_error(503, {"Retry-After": "7"}).response) == 7
+    date = formatdate(time.time() + 30, usegmt=True)
+    assert 25 < retry_after(http_error(503, {"Retry-After": date}).response) <= 30
+    assert retry_after(http_error(503, {"Retry-After": "soon"}).response) is None
+    assert retry_after(http_error(503).response) is None
+    assert retry_after(None) is None
+
+
+def test_retry_until_success(sleeps):
+    calls = []
+
+    @retry(5, base=1, cap=4)
+    def flaky():
+        calls.append(None)
+        if len(calls) < 4:
+            raise ConnectionError("reset")
+        return "ok"
+
+    assert flaky() == "ok"
+    assert len(calls) == 4
+    # full jitter under a doubling cap
+    assert len(sleeps) == 3
+    assert all(0 <= delay <= cap for delay, cap in zip(sleeps, (1, 2, 4)))
+
+
+def test_retry_gives_up(sleeps):
+    @retry(3)
+    def failing():
+        raise ConnectionError("reset")
+
+    with pytest.raises(Exception, match="after 3 tries") as info:
+        failing()
+    assert isinstance(info.value.__cause__, ConnectionError)
+    assert len(sleeps) == 2
+
+
+def test_retry_honours_retry_after(sleeps):
+    calls = []
+
+    @retry(3, base=0.001)
+    def throttled():
+        calls.append(None)
+        if len(calls) == 1:
+            raise http_error(429, {"Retry-After": "12"})
+        return "ok"
+
+    assert throttled() == "ok"
+    assert sleeps == [12]
+
+
+@pytest.mark.parametrize("status, tries", [(404, 1), (403, 1), (408, 3), (500, 3)])
+def test_retry_skips_client_errors(sleeps, status, tries):
+    calls = []
+
+    @retry(3)
+    def failing():
+        calls.append(None)
+        raise http_error(status)
+
+    with pytest.raises(Exception, match=f"after {tries} tries"):
+        failing()
+    assert len(calls) == tries
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(50)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    # the first token is there from the start, the other ten take 20 ms each
+    assert 0.15 < time.monotonic() - start < 0.5
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(None)
+    assert bucket.acquire() == 0
+    bucket.pause(0.2)
+    start = time.monotonic()
+    assert bucket.acquire() > 0
+    assert time.monotonic() - start >= 0.19
+
+
+class SlowDownHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.hits.append(time.monotonic())
+        status = 429 if len(self.hits) == 1 else 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0.3")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def test_throttled_adapter_slows_down():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowDownHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    session = requests.Session()
+    session.mount("http://", ThrottledAdapter(Throttle()))
+    try:
+        assert session.get(url).status_code == 429
+        assert session.get(url).status_code == 200
+    finally:
+        server.shutdown()
+    first, second = SlowDownHandler.hits
+    assert second - first >= 0.29
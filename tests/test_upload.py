@@ -0,0 +1,240 @@
+import io
+import os
+import threading
+import http.server
+
+import pytest
+from PIL import Image
+
+# no user-config.py of pywikibot is needed to download
+os.environ.setdefault("PYWIKIBOT_NO_USER_CONFIG", "1")
+import upload
+from journal import Journal, METADATA_UPDATED, UPLOADED
+from standin import Standin
+
+
+def scan():
+    img = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 180, 150)).save(img, format="JPEG")
+    return img.getvalue()
+
+
+# Serves `bodies` by path, with a Content-Length unless `unsized`, and Range
+# requests the way the image host answers them.
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    bodies = {}
+    unsized = set()
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.bodies[self.path]
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"][6:].split("-")[0])
+            self.ranges.append(start)
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+            )
+        if self.path in self.unsized:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+
+@pytest.fixture
+def server():
+    ImageHandler.bodies, ImageHandler.unsized, ImageHandler.ranges = {}, set(), []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_fetch_file(server, tmp_path):
+    ImageHandler.bodies["/0001.jpg"] = scan()
+    path = upload.fetch_file(f"{server}/0001.jpg", tmp_path / "0001.jpg")
+    assert path.read_bytes() == ImageHandler.bodies["/0001.jpg"]
+    assert ImageHandler.ranges == []
+
+
+def test_fetch_file_resumes(server, tmp_path):
+    ImageHandler.bodies["/0001.jpg"] = body = scan()
+    # what an earlier try left behind
+    path = tmp_path / "0001.jpg"
+    path.write_bytes(body[:100])
+    upload.fetch_file(f"{server}/0001.jpg", path)
+    assert path.read_bytes() == body
+    assert ImageHandler.ranges == [100]
+
+
+def test_fetch_file_starts_over(server, tmp_path, no_backoff):
+    ImageHandler.bodies["/0001.jpg"] = body = scan()
+    # longer than the file on the server, e.g. of an image replaced since
+    path = tmp_path / "0001.jpg"
+    path.write_bytes(body + b"stale")
+    upload.fetch_file(f"{server}/0001.jpg", path)
+    assert path.read_bytes() == body
+    assert ImageHandler.ranges == [len(body) + 5]
+
+
+def test_fetch_file_keeps_complete_scans_without_eoi(server, tmp_path):
+    ImageHandler.bodies["/0001.jpg"] = body = scan()[:-2]
+    path = upload.fetch_file(f"{server}/0001.jpg", tmp_path / "0001.jpg")
+    assert path.read_bytes() == body
+    assert ImageHandler.ranges == []
+
+
+def test_fetch_file_retries_unsized_without_eoi(server, tmp_path, no_backoff):
+    ImageHandler.bodies["/0001.jpg"] = scan()[:-2]
+    ImageHandler.unsized.add("/0001.jpg")
+    with pytest.raises(Exception, match="after 7 tries") as info:
+        upload.fetch_file(f"{server}/0001.jpg", tmp_path / "0001.jpg")
+    assert "Truncated JPEG" in str(info.value.__cause__)
+
+
+def test_fetch_volume_through_cut_downloads(data_dir, tmp_path, no_backoff):
+    standin = Standin(data_dir, max_images=4, image_size=(64, 64), truncate_rate=0.5)
+    base_url = standin.serve()
+    try:
+        urls = [f"{base_url}/img/1/0/{i:04d}.jpg" for i in range(4)]
+        output = tmp_path / "volume.pdf"
+        upload.fetch_volume("volume.pdf", urls, output, 2, None, None, False)
+    finally:
+        standin.shutdown()
+    assert standin.stats()["failures"]["truncated"]
+    assert output.read_bytes().startswith(b"%PDF")
+    # every page made it, none of them as a placeholder
+    assert output.read_bytes().count(b"/DCTDecode") == 4
+
+
+# A file page on Commons that already exists, as far as upload_volume goes.
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+        self.saved = []
+
+    def title(self):
+        return "File:YNUTCM-1.pdf"
+
+    def exists(self):
+        return True
+
+    def save(self, summary):
+        self.saved.append((summary, self.text))
+        return True
+
+
+@pytest.fixture
+def volume(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload, "rate_limit", upload.RateLimit(None))
+    monkeypatch.setattr(upload, "stop", threading.Event())
+    journal = Journal(tmp_path / "journal.sqlite")
+    journal.plan([("YNUTCM-1.pdf", "1.json", 0)])
+    job = {
+        "filename": "YNUTCM-1.pdf",
+        "page": FakePage("== wikitext ==\n"),
+        "category_page": None,
+        "wikitext": "== wikitext ==\n\n    ",
+        "comment": "Upload",
+        "image_urls": ["http://example.org/0001.jpg"],
+    }
+    return job, journal
+
+
+def test_unchanged_wikitext_is_not_saved(volume):
+    job, journal = volume
+    states = journal.states()
+    assert upload.upload_volume(job, None, {}, states, journal, None) == "unchanged"
+    assert job["page"].saved == []
+    assert journal.states()["YNUTCM-1.pdf"] == METADATA_UPDATED
+
+    # nor recorded again once done
+    journal.record("YNUTCM-1.pdf", UPLOADED)
+    states = journal.states()
+    assert upload.upload_volume(job, None, {}, states, journal, None) == "unchanged"
+    assert journal.states()["YNUTCM-1.pdf"] == UPLOADED
+
+
+def test_changed_wikitext_is_saved(volume):
+    job, journal = volume
+    job["page"].text = "== old wikitext =="
+    states = journal.states()
+    assert upload.upload_volume(job, None, {}, states, journal, None) == "changed"
+    assert job["page"].saved == [("Upload (Updating metadata)", job["wikitext"])]
+    assert journal.states()["YNUTCM-1.pdf"] == METADATA_UPDATED
+
+
+# Answers the imageinfo queries of verify() with `result`.
+class FakeSite:
+    def __init__(self, result):
+        self.result = result
+        self.requests = []
+
+    def simple_request(self, **params):
+        self.requests.append(params)
+        return self
+
+    def submit(self):
+        return self.result
+
+
+def test_imageinfo():
+    info = {"size": 1000, "sha1": "da39a3ee", "pagecount": 3}
+    site = FakeSite(
+        {
+            "query": {
+                "normalized": [{"from": "File:A_1.pdf", "to": "File:A 1.pdf"}],
+                "pages": {
+                    "-1": {"title": "File:Missing.pdf", "missing": ""},
+                    "7": {"title": "File:A 1.pdf", "imageinfo": [info]},
+                    "8": {"title": "File:B.pdf", "imageinfo": [info]},
+                },
+            }
+        }
+    )
+    titles = ["File:A_1.pdf", "File:B.pdf", "File:Missing.pdf"]
+    # under the titles asked for
+    assert upload.imageinfo(site, titles) == {"File:A_1.pdf": info, "File:B.pdf": info}
+    assert site.requests[0]["titles"] == titles
+
+    # with formatversion=2, the pages come as a list
+    site = FakeSite(
+        {"query": {"pages": [{"title": "File:B.pdf", "imageinfo": [info]}]}}
+    )
+    assert upload.imageinfo(site, ["File:B.pdf"]) == {"File:B.pdf": info}
+    assert upload.imageinfo(FakeSite({}), ["File:B.pdf"]) == {}
+
+
+@pytest.mark.parametrize(
+    "info, uploaded, problem",
+    [
+        ({"size": 1000, "sha1": "aa", "pagecount": 3}, ("aa", 1000), None),
+        # nothing known of what was uploaded, e.g. by an earlier version
+        ({"size": 1000, "sha1": "aa", "pagecount": 3}, None, None),
+        (None, ("aa", 1000), "missing"),
+        ({"size": 600, "sha1": "bb", "pagecount": 3}, ("aa", 1000), "truncated"),
+        ({"size": 1000, "sha1": "aa"}, None, "truncated"),
+        ({"size": 1000, "sha1": "aa", "pagecount": 2}, None, "truncated"),
+        ({"size": 1000, "sha1": "bb", "pagecount": 3}, ("aa", 1000), "mismatched"),
+        ({"size": 1000, "sha1": "aa", "pagecount": 4}, None, "mismatched"),
+    ],
+)
+def test_check_file(info, uploaded, problem):
+    # three pages, the GIF left out of the PDF
+    volume = {"image_urls": ["1.jpg", "2.jpeg", "3.jpg", "4.gif"]}
+    result = upload.check_file(volume, info, uploaded)
+    assert (result and result.split(":")[0]) == problem
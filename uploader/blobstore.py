@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY, size INTEGER, last_used REAL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    key TEXT PRIMARY KEY, digest TEXT REFERENCES blobs(digest)
+);
+"""
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link_or_copy(src, dest):
+    # never write through an existing dest, which may be linked to a blob
+    Path(dest).unlink(missing_ok=True)
+    try:
+        os.link(src, dest)
+    except OSError:  # e.g. across file systems
+        shutil.copyfile(src, dest)
+
+
+# A content-addressed store of files, e.g. downloaded page images and built
+# PDFs, with an index from keys such as source URLs to content hashes.
+#
+# Files are stored under their SHA-256 and checked against it whenever they are
+# read back. Once the store grows past `max_size` bytes, the least recently used
+# files are evicted. Files go in and out by hard link where possible, so putting
+# a file in the store or taking it out does not cost another copy.
+class BlobStore:
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        (self.directory / "objects").mkdir(parents=True, exist_ok=True)
+        # shared by the threads and, in WAL mode, by the processes of the uploader
+        self.db = sqlite3.connect(
+            self.directory / "index.sqlite", timeout=60, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        return self.directory / "objects" / digest[:2] / digest
+
+    def get(self, key, dest):
+        # -> whether the file stored under `key` is now at `dest`
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest FROM refs WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return False
+        (digest,) = row
+        try:
+            link_or_copy(self.path(digest), dest)
+        except FileNotFoundError:
+            self.drop(digest)
+            return False
+        if file_digest(dest) != digest:
+            logger.warning(f"Blob {digest} for {key} is corrupted, dropping")
+            os.unlink(dest)
+            self.drop(digest)
+            return False
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), digest)
+            )
+        return True
+
+    def put(self, key, path):
+        digest = file_digest(path)
+        blob_path = self.path(digest)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(exist_ok=True)
+            tmp_path = blob_path.with_name(
+                f"{digest}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            link_or_copy(path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                (digest, blob_path.stat().st_size, time.time()),
+            )
+            self.db.execute("INSERT OR REPLACE INTO refs VALUES (?, ?)", (key, digest))
+            self._evict()
+        return digest
+
+    def drop(self, digest):
+        with self.lock, self.db:
+            self._drop(digest)
+
+    def _drop(self, digest):
+        self.db.execute("DELETE FROM refs WHERE digest = ?", (digest,))
+        self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        self.path(digest).unlink(missing_ok=True)
+
+    def _evict(self):
+        (size,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        if size <= self.max_size:
+            return
+        for digest, blob_size in self.db.execute(
+            "SELECT digest, size FROM blobs ORDER BY last_used"
+        ).fetchall():
+            if size <= self.max_size * 0.9:
+                break
+            self._drop(digest)
+            size -= blob_size
+        logger.debug(f"Evicted blob store down to {size} B")
@@ -1,22 +1,149 @@
 #!/usr/bin/env python3
-import yaml
 import os
 import re
-import json
 import sys
-import functools
+import json
+import hashlib
+import logging
+import argparse
 from pathlib import Path
-from zhconv_rs import zhconv
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import mwclient
 
-CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
-DATA_DIR = Path(__file__).parent / "../crawler/data"
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common import catalog
+import plan
+from plan import load_config, load_manifest, plan_book, zhconv, ZHCONV_VERSION
+
+# bump when render_section changes, so that the cached sections are not used
+RENDERER = "gentable 2"
+# config options the sections do not depend on
+CREDENTIALS = ("username", "password")
+WORKERS = os.cpu_count()
+# books rendered per task when rendering in parallel
+CHUNK_BOOKS = 32
+
+logger = logging.getLogger(__name__)
+
+
+def render_section(book):
+    # -> lines of a manifest entry in the list
+    lines = [f"* 《{book['title'] or ''}》 {book['author']}"]
+    for volume in book["volumes"]:
+        lines.append(f"** [[:{volume['pagename']}]]")
+    return "\n".join(lines)
+
+
+def digest(path, salt):
+    # of the JSON file of a book and whatever else its section depends on
+    h = hashlib.sha256(salt.encode())
+    h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+# of the worker process, set up by init_worker
+worker_db = None
+
+
+def init_worker(data_dir):
+    global worker_db
+    worker_db = catalog.connect(data_dir)
+    zhconv.load(worker_db)
+
+
+def render_books(book_ids, data_dir, config):
+    # -> book id -> section, and the conversions that were not in the catalog
+    sections = {
+        book_id: render_section(plan_book(data_dir / f"{book_id}.json", book, config))
+        for book_id, book in catalog.load_books(worker_db, book_ids)
+    }
+    new, zhconv.new = zhconv.new, {}
+    return sections, new
+
+
+def render_table(config, data_dir, workers=WORKERS):
+    # Renders the sections of all books in book id order. A section is cached in
+    # the catalog along with a digest of what it was rendered from, so only the
+    # books that changed since the last run are rendered, in parallel if many.
+    db = catalog.connect(data_dir)
+    catalog.sync(db, data_dir)
+    book_ids = catalog.book_ids(db)
+    salt = json.dumps(
+        [
+            RENDERER,
+            ZHCONV_VERSION,
+            {k: v for k, v in config.items() if k not in CREDENTIALS},
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    with ThreadPoolExecutor(workers) as executor:
+        digests = dict(
+            zip(
+                book_ids,
+                executor.map(
+                    lambda book_id: digest(data_dir / f"{book_id}.json", salt),
+                    book_ids,
+                ),
+            )
+        )
+    cached = catalog.load_renders(db, RENDERER)
+    sections = {book_id: section for book_id, (_, section) in cached.items()}
+    changed = [
+        book_id
+        for book_id in book_ids
+        if book_id not in cached or cached[book_id][0] != digests[book_id]
+    ]
+    logger.info(f"Rendering {len(changed)} of {len(book_ids)} books")
+    if changed:
+        chunks = [
+            changed[i : i + CHUNK_BOOKS] for i in range(0, len(changed), CHUNK_BOOKS)
+        ]
+        if len(chunks) > 1 and workers > 1:
+            with ProcessPoolExecutor(
+                min(workers, len(chunks)), initializer=init_worker, initargs=(data_dir,)
+            ) as executor:
+                results = list(
+                    executor.map(render_books, chunks, repeat(data_dir), repeat(config))
+                )
+        else:
+            init_worker(data_dir)
+            results = [render_books(changed, data_dir, config)]
+        rendered = {}
+        for chunk_sections, conversions in results:
+            rendered.update(chunk_sections)
+            catalog.store_conversions(db, ZHCONV_VERSION, conversions)
+        catalog.store_renders(
+            db,
+            RENDERER,
+            {book_id: (digests[book_id], rendered[book_id]) for book_id in rendered},
+        )
+        sections.update(rendered)
+    return [sections[book_id] for book_id in book_ids]
 
 
 def main():
-    with open(CONFIG_FILE_PATH, "r") as f:
-        config = yaml.safe_load(f.read())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "pagename", nargs="?", help="page to write to, instead of printing"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        help="list what a manifest written by plan.py lists, instead of planning afresh",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="number of processes to render changed books with",
+    )
+    args = parser.parse_args()
+
+    config = load_config()
 
     def getopt(item, default=None):  # get batch config or fallback to global config
         return config.get(item, config.get(item, default))
@@ -25,69 +152,41 @@ def main():
     batch_link = getopt("link") or getopt("name")
     category_name = re.search(r"(Category:.+?)[]|]", batch_link).group(1)
 
-    book_paths = sorted(DATA_DIR.glob("*.json"))
-    books = []
-    for book_path in book_paths:
-        with open(book_path) as f:
-            book = json.load(f)
-            books.append(book)
+    if args.manifest:
+        sections = [render_section(book) for book in load_manifest(args.manifest)]
+    else:
+        sections = render_table(config, Path(plan.DATA_DIR), args.workers)
+    # a line per volume after the line of its book
+    files = sum(section.count("\n** ") for section in sections)
 
     lines = [
-        f"Category: {batch_link}, Template: {{{{Template|{template}}}}}, Books: {len(books)}, Files: {sum(map(lambda e: len(e['fulltextpath']), books))}\n",
+        f"Category: {batch_link}, Template: {{{{Template|{template}}}}}, Books: {len(sections)}, Files: {files}\n",
+        *sections,
     ]
 
-    for book in books:
-        title = zhconv(book["detail"]["title"] or "", "zh-hant")
-        byline = zhconv(book["detail"]["author"] or "", "zh-hant")
-        lines.append(f"* 《{title}》 {byline}")
-
-        for ivol, (volume_name, volume_path, image_urls) in enumerate(
-            map(lambda triple: triple.values(), book["fulltextpath"])
-        ):
-            # pagename = "File:" + book['name'] + ".pdf"
-            # volume_name = f"第{ivol+1}冊" if len(volurls) > 1 else ""
-            # volume_name_wps = (
-            #    (" " + volume_name) if volume_name else ""
-            # )  # with preceding space
-            # filename = f'{book["name"]}{volume_name_wps}.pdf'
-            volume_name = zhconv(
-                volume_name.strip().replace("(", "（").replace(")", "）"), "zh-hant"
-            )
-            volume_name = re.sub(
-                r"\s+",
-                " ",
-                (
-                    volume_name.strip()
-                    .replace("(", "（")
-                    .replace(")", "）")
-                    .replace("{", "（")
-                    .replace("}", "）")
-                ),
-            )
-
-            filename = f"YNUTCM-{volume_name}.pdf"
-            pagename = "File:" + filename
-            assert all(char not in set(r'["$*|\]</^>@#') for char in pagename)
-            comment = f'Upload {title} {volume_name} ({1+ivol}/{len(book["fulltextpath"])}) by {byline} (batch task; ynutcm; {batch_link}; [[{category_name}|{title}]])'
-            lines.append(f"** [[:{pagename}]]")
-
     lines.append("")
     lines.append("[[" + category_name + "]]")
     lines.append("")
+    text = "\n".join(lines)
 
-    if len(sys.argv) < 2:
-        print("\n".join(lines))
+    if args.pagename is None:
+        print(text)
     else:
+        pagename = args.pagename
+
+        site = mwclient.Site("commons.wikimedia.org")
+        # MediaWiki strips trailing whitespace on save
+        if site.pages[pagename].text().rstrip() == text.rstrip():
+            print(f"File list on {pagename} is up to date")
+            return
         print(f"Writing file list")
-        pagename = sys.argv[1]
 
         username, password = config["username"], config["password"]
-        site = mwclient.Site("commons.wikimedia.org")
         site.login(username, password)
         site.requests["timeout"] = 125
         site.chunk_size = 1024 * 1024 * 64
 
-        site.pages[pagename].edit("\n".join(lines), f"Writing file list to {pagename}")
+        site.pages[pagename].edit(text, f"Writing file list to {pagename}")
 
 
 if __name__ == "__main__":
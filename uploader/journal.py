@@ -0,0 +1,185 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PLANNED = "planned"
+DOWNLOADED = "downloaded"
+UPLOADED = "uploaded"
+METADATA_UPDATED = "metadata-updated"
+SKIPPED = "skipped"
+FAILED = "failed"
+# missing on Commons or differing from the upload, as found by a verification
+MISMATCHED = "mismatched"
+STATES = (PLANNED, DOWNLOADED, UPLOADED, METADATA_UPDATED, SKIPPED, FAILED, MISMATCHED)
+# nothing left to do for volumes in these states
+DONE_STATES = (UPLOADED, METADATA_UPDATED, SKIPPED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    filename TEXT PRIMARY KEY,
+    book_path TEXT,
+    nth INTEGER,
+    state TEXT,
+    reason TEXT,
+    attempts INTEGER DEFAULT 0,
+    updated_at REAL,
+    owner TEXT,
+    sha1 TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS volumes_state ON volumes (state);
+CREATE INDEX IF NOT EXISTS volumes_book ON volumes (book_path);
+"""
+
+
+# A durable record of where each volume of a batch stands, kept in SQLite.
+#
+# Every state change is committed as it happens, so a run that is interrupted
+# resumes at the volume it was working on rather than at the book, and volumes
+# that failed are remembered with the reason until they are retried. The
+# database is in WAL mode, so several processes can read and write the same
+# journal at the same time. Workers claim whole books before processing them;
+# claims are held until the claiming process is gone. The SHA-1 and size of the
+# PDFs uploaded are kept as well, for the uploads to be verified against.
+class Journal:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(volumes)")]
+        # for journals from before there were workers and verification
+        for column, kind in (("owner", "TEXT"), ("sha1", "TEXT"), ("size", "INTEGER")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE volumes ADD COLUMN {column} {kind}")
+        self.lock = threading.Lock()
+
+    def plan(self, volumes):
+        # record (filename, book path, nth) of the volumes not journaled yet
+        volumes = list(volumes)
+        # rows are keyed by file name, so volumes sharing one would be merged
+        counts = Counter(filename for filename, _, _ in volumes)
+        duplicated = sorted(filename for filename, count in counts.items() if count > 1)
+        if duplicated:
+            raise ValueError(
+                f"File names planned for more than one volume: {duplicated}"
+            )
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO volumes"
+                " (filename, book_path, nth, state, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    (filename, book_path, nth, PLANNED, time.time())
+                    for filename, book_path, nth in volumes
+                ),
+            )
+
+    def states(self):
+        # -> filename -> state
+        with self.lock:
+            return dict(self.db.execute("SELECT filename, state FROM volumes"))
+
+    def record(self, filename, state, reason=None):
+        assert state in STATES, state
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE volumes SET state = ?, reason = ?, updated_at = ?,"
+                " attempts = attempts + ? WHERE filename = ?",
+                (state, reason, time.time(), state == FAILED, filename),
+            )
+
+    def record_file(self, filename, sha1, size):
+        # of the PDF uploaded for a volume
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE volumes SET sha1 = ?, size = ? WHERE filename = ?",
+                (sha1, size, filename),
+            )
+
+    def files(self):
+        # -> filename -> (SHA-1, size) of the PDFs uploaded
+        with self.lock:
+            return {
+                filename: (sha1, size)
+                for filename, sha1, size in self.db.execute(
+                    "SELECT filename, sha1, size FROM volumes WHERE sha1 IS NOT NULL"
+                )
+            }
+
+    def claim(self, book_paths, owner, count, since=None):
+        # -> up to `count` books from the iterator `book_paths`, which is consumed
+        # only as far as needed, that nobody else had claimed and `owner` now has;
+        # books with a volume recorded `since` then are left out, as another
+        # worker of the same run is done with them and has released them
+        claimed = []
+        with self.lock, self.db:
+            for book_path in book_paths:
+                if self.db.execute(
+                    "UPDATE volumes SET owner = ?"
+                    " WHERE book_path = ? AND (owner IS NULL OR owner = ?)"
+                    " AND NOT EXISTS (SELECT 1 FROM volumes"
+                    " WHERE book_path = ? AND updated_at >= ?)",
+                    (owner, book_path, owner, book_path, since or float("inf")),
+                ).rowcount:
+                    claimed.append(book_path)
+                    if len(claimed) == count:
+                        break
+        return claimed
+
+    def release(self, owner):
+        with self.lock, self.db:
+            self.db.execute("UPDATE volumes SET owner = NULL WHERE owner = ?", (owner,))
+
+    def claims(self):
+        # -> owner -> number of books claimed
+        with self.lock:
+            return dict(
+                self.db.execute(
+                    "SELECT owner, COUNT(DISTINCT book_path) FROM volumes"
+                    " WHERE owner IS NOT NULL GROUP BY owner"
+                )
+            )
+
+    def release_stale(self):
+        # drop the claims of processes on this host that are gone
+        host = socket.gethostname()
+        with self.lock, self.db:
+            for (owner,) in self.db.execute(
+                "SELECT DISTINCT owner FROM volumes WHERE owner IS NOT NULL"
+            ).fetchall():
+                owner_host, pid = owner.rsplit("/", 1)
+                if owner_host != host:
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:  # alive, but someone else's
+                    continue
+                logger.info(f"Releasing the claims of {owner}")
+                self.db.execute(
+                    "UPDATE volumes SET owner = NULL WHERE owner = ?", (owner,)
+                )
+
+    def failures(self):
+        # -> (filename, reason, attempts) of the failed volumes
+        with self.lock:
+            return self.db.execute(
+                "SELECT filename, reason, attempts FROM volumes WHERE state = ?"
+                " ORDER BY book_path, nth",
+                (FAILED,),
+            ).fetchall()
+
+    def summary(self):
+        # -> state -> number of volumes
+        with self.lock:
+            return dict(
+                self.db.execute("SELECT state, COUNT(*) FROM volumes GROUP BY state")
+            )
@@ -0,0 +1,135 @@
+import shutil
+import logging
+from io import BytesIO
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# same as img2pdf
+DEFAULT_DPI = 96
+
+COLORSPACES = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}
+# EXIF orientation -> page rotation
+ROTATIONS = {1: 0, 3: 180, 6: 90, 8: 270}
+
+
+# Writes a PDF of JPEG pages to `f` as the pages come in, one page at a time.
+#
+# Unlike img2pdf, which keeps every image around until the whole document is
+# serialized, only the byte offsets of the objects written so far are kept. The
+# JPEGs are embedded as-is with DCTDecode, laid out the way img2pdf does by
+# default, i.e. one image per page sized after its DPI. Pages drawn otherwise,
+# such as the placeholders of placeholder.py, can go in between with add_page.
+class PdfWriter:
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        self.kids = []
+        self.fonts = {}
+        # 1 and 2 are reserved for the catalog and the page tree
+        self.next_id = 3
+        self.f.write(b"%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    def allocate(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % obj_id)
+        self.f.write(body)
+        if stream is not None:
+            self.f.write(b"\nstream\n")
+            if isinstance(stream, bytes):
+                self.f.write(stream)
+            else:
+                shutil.copyfileobj(stream, self.f)
+            self.f.write(b"\nendstream")
+        self.f.write(b"\nendobj\n")
+
+    def standard_font(self, name):
+        # -> object id of one of the standard 14 fonts, which need no embedding
+        if name not in self.fonts:
+            self.fonts[name] = self.allocate()
+            self.write_object(
+                self.fonts[name],
+                b"<< /Type /Font /Subtype /Type1 /BaseFont /%s"
+                b" /Encoding /WinAnsiEncoding >>" % name,
+            )
+        return self.fonts[name]
+
+    def add_page(self, width, height, content, resources=b"<< >>", rotate=0):
+        # a page of `width` x `height` points, drawn by the `content` stream
+        content_id, page_id = self.allocate(), self.allocate()
+        self.write_object(content_id, b"<< /Length %d >>" % len(content), content)
+        self.write_object(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %0.4f %0.4f]"
+            b" /Resources %s /Contents %d 0 R%s >>"
+            % (
+                width,
+                height,
+                resources,
+                content_id,
+                b" /Rotate %d" % rotate if rotate else b"",
+            ),
+        )
+        self.kids.append(page_id)
+
+    def add_jpeg(self, path):
+        with Image.open(path) as img:  # only reads the header
+            if img.format != "JPEG" or img.mode not in COLORSPACES:
+                logger.warning(f"Re-encoding {img.format} {img.mode} page {path}")
+                blob = BytesIO()
+                img.convert("RGB").save(blob, format="JPEG", quality=95)
+                self.add_jpeg(BytesIO(blob.getvalue()))
+                return
+            width, height = img.size
+            mode = img.mode
+            dpi = img.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+            dpi = tuple(round(d) or DEFAULT_DPI for d in dpi)
+            adobe = "adobe" in img.info
+            rotate = ROTATIONS.get(img.getexif().get(0x0112, 1), 0)
+
+        image_id = self.allocate()
+        image_dict = (
+            b"<< /Type /XObject /Subtype /Image /Filter /DCTDecode"
+            b" /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8"
+            % (width, height, COLORSPACES[mode].encode())
+        )
+        if mode == "CMYK" and adobe:
+            image_dict += b" /Decode [1 0 1 0 1 0 1 0]"
+        data = path if isinstance(path, BytesIO) else open(path, "rb")
+        length = data.seek(0, 2)
+        data.seek(0)
+        with data:
+            self.write_object(image_id, image_dict + b" /Length %d >>" % length, data)
+
+        page_width = width * 72 / dpi[0]
+        page_height = height * 72 / dpi[1]
+        content = b"q\n%0.4f 0 0 %0.4f 0 0 cm\n/Im0 Do\nQ" % (page_width, page_height)
+        self.add_page(
+            page_width,
+            page_height,
+            content,
+            b"<< /XObject << /Im0 %d 0 R >> >>" % image_id,
+            rotate,
+        )
+
+    def close(self):
+        kids = b" ".join(b"%d 0 R" % kid for kid in self.kids)
+        self.write_object(
+            2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.kids))
+        )
+        xref_offset = self.f.tell()
+        self.f.write(b"xref\n0 %d\n" % self.next_id)
+        self.f.write(b"0000000000 65535 f \n")
+        for obj_id in range(1, self.next_id):
+            self.f.write(b"%010d 00000 n \n" % self.offsets[obj_id])
+        self.f.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (self.next_id, xref_offset)
+        )
@@ -0,0 +1,158 @@
+import datetime
+import textwrap
+import functools
+from io import BytesIO
+from pathlib import Path
+from datetime import timezone
+from urllib.parse import quote as urlquote
+
+from PIL import Image, ImageFont
+from qrcode import QRCode
+
+from pdfstream import DEFAULT_DPI
+
+# Placeholder pages for images that failed to download: a few lines on the broken
+# URL and a QR code of it. They are either drawn as vector graphics right into
+# the PDF, which costs next to nothing, or rasterized to a JPEG the way they used
+# to be, with the font loaded and each glyph rendered only once per process.
+
+FONT_FILE_PATH = Path(__file__).parent / "Aileron-Regular.otf"
+FONT_SIZE = 20
+# of the vector pages, which need no font embedded
+PDF_FONT = b"Courier"
+PDF_FONT_ADVANCE = 0.6  # of the font size, for every glyph of Courier
+PDF_FONT_ASCENT = 0.8
+QR_BOX_SIZE = 3
+# any of the eight does; trying them all for the best takes most of the time
+QR_MASK_PATTERN = 0
+MARGIN = (5, 5)
+SPACING = 3
+
+
+def placeholder_lines(url, page_name=""):
+    t = datetime.datetime.now(timezone.utc)
+    if page_name:
+        page_name = " " + page_name
+    return [
+        f"The page{page_name} links to an broken url:",
+        *textwrap.wrap(urlquote(url, safe=":/"), break_on_hyphens=False),
+        "Access time: " + str(t),
+    ]
+
+
+def qr_matrix(url):
+    # -> rows of modules, True for dark, the quiet zone included
+    qr = QRCode(box_size=QR_BOX_SIZE, mask_pattern=QR_MASK_PATTERN)
+    qr.add_data(url)
+    qr.make()
+    return qr.get_matrix()
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(path=FONT_FILE_PATH, size=FONT_SIZE):
+    return ImageFont.truetype(str(path), size=size)
+
+
+@functools.lru_cache(maxsize=None)
+def glyph(char):
+    # -> (mask, offset from the pen position, advance)
+    font = load_font()
+    mask, offset = font.getmask2(char, "L")
+    return mask, offset, font.getlength(char)
+
+
+def line_width(line):
+    return round(sum(glyph(char)[2] for char in line))
+
+
+def render_jpeg(url, page_name=""):
+    lines = placeholder_lines(url, page_name)
+    matrix = qr_matrix(url)
+    ascent, descent = load_font().getmetrics()
+    qr_size = len(matrix) * QR_BOX_SIZE
+    width = max(max(line_width(line) for line in lines), qr_size) + MARGIN[0] * 2
+    height = (
+        len(lines) * (ascent + descent) + MARGIN[1] * 2 + len(lines) * SPACING + qr_size
+    )
+    img = Image.new("RGB", (width, height), (255, 255, 255))
+    y = MARGIN[1]
+    for line in lines:
+        x = MARGIN[0]
+        for char in line:
+            mask, (dx, dy), advance = glyph(char)
+            if mask.size[0] and mask.size[1]:
+                left, top = round(x) + dx, y + dy
+                # need to use the inner `img.im.paste` due to `getmask2` returning
+                # a core image
+                img.im.paste(
+                    (0, 0, 0),
+                    (left, top, left + mask.size[0], top + mask.size[1]),
+                    mask,
+                )
+            x += advance
+        y += ascent + descent + SPACING
+    qr_img = Image.new("1", (len(matrix), len(matrix)), 1)
+    qr_img.putdata([0 if dark else 1 for row in matrix for dark in row])
+    img.paste(qr_img.resize((qr_size, qr_size), Image.NEAREST), (0, y))
+
+    output = BytesIO()
+    img.save(output, format="JPEG")
+    return output.getvalue()
+
+
+def pdf_string(text):
+    escaped = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return b"(" + escaped.encode("latin-1", "replace") + b")"
+
+
+def add_vector_page(pdf, url, page_name=""):
+    # Adds the placeholder to `pdf`, a PdfWriter, as text and rectangles laid
+    # out like the JPEG, at the same scale.
+    lines = placeholder_lines(url, page_name)
+    matrix = qr_matrix(url)
+    line_height = FONT_SIZE + SPACING
+    qr_size = len(matrix) * QR_BOX_SIZE
+    width = (
+        max(max(len(line) for line in lines) * FONT_SIZE * PDF_FONT_ADVANCE, qr_size)
+        + MARGIN[0] * 2
+    )
+    height = len(lines) * line_height + MARGIN[1] * 2 + qr_size
+    scale = 72 / DEFAULT_DPI
+
+    # in pixels from the top left, as the JPEG is laid out
+    ops = [b"%0.4f 0 0 %0.4f 0 %0.4f cm" % (scale, -scale, height * scale)]
+    ops.append(b"BT /F1 %d Tf" % FONT_SIZE)
+    for n, line in enumerate(lines):
+        baseline = MARGIN[1] + n * line_height + FONT_SIZE * PDF_FONT_ASCENT
+        ops.append(
+            b"1 0 0 -1 %d %0.2f Tm %s Tj" % (MARGIN[0], baseline, pdf_string(line))
+        )
+    ops.append(b"ET")
+    top = height - qr_size
+    for r, row in enumerate(matrix):
+        c = 0
+        while c < len(row):
+            if not row[c]:
+                c += 1
+                continue
+            start = c
+            while c < len(row) and row[c]:
+                c += 1
+            ops.append(
+                b"%d %d %d %d re"
+                % (
+                    start * QR_BOX_SIZE,
+                    top + r * QR_BOX_SIZE,
+                    (c - start) * QR_BOX_SIZE,
+                    QR_BOX_SIZE,
+                )
+            )
+    ops.append(b"f")
+
+    font_id = pdf.standard_font(PDF_FONT)
+    pdf.add_page(
+        width * scale,
+        height * scale,
+        b"\n".join(ops),
+        b"<< /Font << /F1 %d 0 R >> >>" % font_id,
+    )
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+import importlib.metadata
+from pathlib import Path
+from collections import Counter
+
+import yaml
+from more_itertools import peekable
+from zhconv_rs import zhconv as zhconv_
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common import catalog
+
+ZHCONV_VERSION = "zhconv-rs " + importlib.metadata.version("zhconv-rs")
+
+CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
+DATA_DIR = Path(__file__).parent / "../crawler/data"
+MANIFEST_PATH = Path(__file__).parent / "manifest.json"
+
+# of the category of a book, by its title
+CATEGORY_WIKITEXT = """{{Wikidata Infobox}}
+{{Category for book|zh}}
+{{zh|%s}}
+
+[[Category:Chinese-language books by title]]
+    """
+
+LOGLEVEL = os.environ.get("LOGLEVEL", "INFO").upper()
+logging.basicConfig(level=LOGLEVEL)
+logger = logging.getLogger(__name__)
+
+
+# Converts each distinct string once per variant, passing anything that is not a
+# string through. Results are kept in the catalog along with the version of
+# zhconv-rs, so later runs only convert what is new.
+class Converter:
+    def __init__(self):
+        self.results = {}
+        self.new = {}
+
+    def __call__(self, s, variant):
+        if type(s) != str:
+            return s
+        key = (variant, s)
+        if key not in self.results:
+            self.results[key] = self.new[key] = zhconv_(s, variant)
+        return self.results[key]
+
+    def load(self, db):
+        self.results.update(catalog.load_conversions(db, ZHCONV_VERSION))
+
+    def save(self, db):
+        catalog.store_conversions(db, ZHCONV_VERSION, self.new)
+        self.new = {}
+
+
+zhconv = Converter()
+
+
+def load_config():
+    with open(CONFIG_FILE_PATH, "r") as f:
+        return yaml.safe_load(f.read())
+
+
+def normalize_volume_name(volume_name):
+    return re.sub(
+        r"\s+",
+        " ",
+        (
+            volume_name.strip()
+            .replace("(", "（")
+            .replace(")", "）")
+            .replace("{", "（")
+            .replace("}", "）")
+        ),
+    )
+
+
+def plan_book(path, book, config):
+    # -> manifest entry of a book, with everything needed to upload its volumes
+    def getopt(item, default=None):
+        return config.get(item, config.get(item, default))
+
+    template = getopt("template")
+    batch_link = getopt("link") or getopt("name")
+    booknavi = getopt("booknavi")
+
+    urlid = int(path.stem)
+    title = zhconv(book["detail"]["title"], "zh-hant")
+    category_name = "Category:" + title
+    # as listed by gentable.py, which never had the brackets below applied
+    author = zhconv(book["detail"]["author"] or "", "zh-hant")
+    byline = author
+    if getopt("apply_tortoise_shell_brackets_to_starting_of_byline", False):
+        # e.g. "(魏)王弼,(晋)韩康伯撰   (唐)邢璹撰"
+        byline = re.sub(
+            r"^([（(〔[][题題][]）)〕])?[（(〔[](.{0,3}?)[]）)〕]",
+            r"\1〔\2〕",
+            byline,
+        )
+    category_wikitext = CATEGORY_WIKITEXT % title
+
+    def genvols():
+        for ivol, (volume_name, volume_path, image_urls) in enumerate(
+            map(lambda triple: triple.values(), book["fulltextpath"])
+        ):
+            # pagename = "File:" + book['name'] + ".pdf"
+            # volume_name = f"第{ivol+1}冊" if len(volurls) > 1 else ""
+            # volume_name_wps = (
+            #    (" " + volume_name) if volume_name else ""
+            # )  # with preceding space
+            volume_name = normalize_volume_name(volume_name)
+            volume_name_simplified = re.sub(r"[0-9-]+(.+?)[0-9-]+$", r"\1", volume_name)
+            filename = zhconv(f"YNUTCM-{volume_name}.pdf", "zh-hant")
+            pagename = "File:" + filename
+            assert all(char not in set(r'["$*|\]</^>@#') for char in pagename)
+            comment = f'Upload {title} {volume_name} ({1+ivol}/{len(book["fulltextpath"])}) by {book["detail"]["author"]} (batch task; ynutcm; {batch_link}; [[{category_name}|{title}]])'
+            yield ivol + 1, filename, pagename, volume_name, volume_path, volume_name_simplified, image_urls, comment
+
+    additional_fields = "\n".join(
+        [
+            f"  |JSONFIELD-{k}={zhconv('' if v is None else v, 'zh-hant')}"
+            for k, v in book["detail"].items()
+        ]
+        + [
+            f"  |JSONFIELD-{k}-original={'' if v is None else v}"
+            for k, v in book["detail"].items()
+        ]
+    )
+
+    volumes = []
+    volsit = peekable(genvols())
+    prev_filename = None
+    for (
+        nth,
+        filename,
+        pagename,
+        volume_name,
+        volume_path,
+        volume_name_simplified,
+        image_urls,
+        comment,
+    ) in volsit:
+        try:
+            next_filename = volsit.peek()[1]
+        except StopIteration:
+            next_filename = None
+        volume_wikitext = f"""=={{{{int:filedesc}}}}==
+{{{{{booknavi}|prev={prev_filename or ""}|next={next_filename or ""}|nth={nth}|total={len(book["fulltextpath"])}|number={book["detail"]["number"]}|totalnum={book["detail"]["totalnum"]}|callnum={book["detail"]["callnum"]}|docNo={book["detail"]["docNo"]}|class={zhconv(book["detail"]["class"], "zh-Hant")}}}}}
+{{{{{template}
+  |bookurlid={urlid}
+  |volname={zhconv(volume_name, 'zh-hant')}
+  |volname-original={volume_name}
+  |volpath={zhconv(volume_path, 'zh-hant')}
+  |volpath-original={volume_path}
+  |simpvolname={zhconv(volume_name_simplified, 'zh-hant')}
+  |byline={byline}
+{additional_fields}
+}}}}
+
+[[{category_name}]]
+    """
+        volumes.append(
+            {
+                "nth": nth,
+                "total": len(book["fulltextpath"]),
+                "filename": filename,
+                "pagename": pagename,
+                "prev": prev_filename,
+                "next": next_filename,
+                "wikitext": volume_wikitext,
+                "comment": comment,
+                "image_count": len(image_urls),
+                "image_urls": image_urls,
+            }
+        )
+        # volumes without images are not uploaded, so not linked to either
+        if image_urls:
+            prev_filename = filename
+
+    return {
+        "id": urlid,
+        "path": str(path),
+        "title": title,
+        "author": author,
+        "byline": byline,
+        "category_name": category_name,
+        "category_wikitext": category_wikitext,
+        "volumes": volumes,
+    }
+
+
+def build_manifest(config):
+    db = catalog.connect(DATA_DIR)
+    catalog.sync(db, DATA_DIR)
+    zhconv.load(db)
+    manifest = [
+        plan_book(DATA_DIR / f"{book_id}.json", book, config)
+        for book_id, book in catalog.load_books(db)
+    ]
+    zhconv.save(db)
+    return manifest
+
+
+def load_manifest(path=MANIFEST_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def collisions(manifest):
+    # -> file names planned for more than one volume
+    counts = Counter(
+        volume["filename"] for book in manifest for volume in book["volumes"]
+    )
+    return sorted(filename for filename, count in counts.items() if count > 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plan the upload offline and write the manifest"
+    )
+    parser.add_argument("output", nargs="?", type=Path, default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    manifest = build_manifest(load_config())
+    with open(args.output, "w") as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+
+    volumes = [volume for book in manifest for volume in book["volumes"]]
+    logger.info(
+        f"Planned {len(manifest)} books, {len(volumes)} files,"
+        f" {sum(volume['image_count'] for volume in volumes)} images"
+        f" into {args.output}"
+    )
+    for volume in volumes:
+        if not volume["image_count"]:
+            logger.warning(f"No images for {volume['pagename']}")
+    duplicated = collisions(manifest)
+    for filename in duplicated:
+        logger.error(f"Colliding file name: {filename}")
+    if duplicated:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import logging
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops
+
+from pdfstream import DEFAULT_DPI
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 85
+# largest difference between color channels of a page that is still gray
+GRAY_TOLERANCE = 12
+# size of the thumbnail pages are checked for grayness on
+GRAY_SAMPLE_SIZE = (256, 256)
+
+
+def is_gray(img):
+    sample = img.copy()
+    sample.thumbnail(GRAY_SAMPLE_SIZE)
+    r, g, b = sample.split()
+    return all(
+        ImageChops.difference(x, y).getextrema()[1] <= GRAY_TOLERANCE
+        for x, y in ((r, g), (g, b), (r, b))
+    )
+
+
+def recompress(
+    path, quality=DEFAULT_QUALITY, max_dimension=None, max_dpi=None, grayscale=False
+):
+    # Re-encodes the JPEG at `path` in place if that makes it smaller, downscaled
+    # to at most `max_dimension` pixels and `max_dpi` on either side and, with
+    # `grayscale`, converted to grayscale if it has no color anyway.
+    # -> (size before, size after)
+    path = Path(path)
+    size = path.stat().st_size
+    with Image.open(path) as img:
+        if img.format != "JPEG" or img.mode not in ("L", "RGB"):
+            return size, size
+        dpi = img.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+        dpi = tuple(round(d) or DEFAULT_DPI for d in dpi)
+        exif, icc_profile = img.info.get("exif"), img.info.get("icc_profile")
+        scale = 1
+        if max_dimension:
+            scale = min(scale, max_dimension / max(img.size))
+        if max_dpi:
+            scale = min(scale, max_dpi / max(dpi))
+        dimensions = tuple(max(1, round(d * scale)) for d in img.size)
+        if scale < 1:
+            # lets libjpeg decode at a fraction of the size right away
+            img.draft(img.mode, dimensions)
+            img = img.resize(dimensions, Image.LANCZOS)
+        if grayscale and img.mode == "RGB" and is_gray(img):
+            img = img.convert("L")
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        img.save(
+            tmp_path,
+            format="JPEG",
+            quality=quality,
+            optimize=True,
+            # the page keeps its physical size
+            dpi=tuple(d * scale for d in dpi),
+            exif=exif or b"",
+            icc_profile=icc_profile,
+        )
+    new_size = tmp_path.stat().st_size
+    if new_size >= size:
+        tmp_path.unlink()
+        return size, size
+    # a new file rather than writing through, as `path` may be linked to a blob
+    os.replace(tmp_path, path)
+    return size, new_size
+
+
+# Runs `recompress` on a pool of processes for the download threads, which each
+# wait for the page they handed over.
+class Recompressor:
+    def __init__(self, workers=None, **options):
+        self.options = options
+        # not forked, as the uploader has threads running by the time the pool
+        # starts its processes
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    @property
+    def key(self):
+        # -> what tells the outputs of different options apart
+        return json.dumps(self.options, sort_keys=True)
+
+    def __call__(self, path):
+        return self.executor.submit(recompress, str(path), **self.options).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
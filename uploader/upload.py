@@ -2,45 +2,76 @@
 import os.path
 import itertools
 import subprocess
-import json
 import logging
-from io import BytesIO
 import os
-import functools
-import re
+import argparse
+import hashlib
+import threading
 import sys
+import time
+import socket
+import multiprocessing
 from itertools import chain
+from collections import Counter
 from pathlib import Path
-from tempfile import gettempdir
-from datetime import timezone
-import datetime
-import textwrap
-from urllib.parse import quote as urlquote
+from tempfile import gettempdir, TemporaryDirectory
+from urllib.parse import quote as urlquote, urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-from more_itertools import peekable
+from more_itertools import peekable, chunked
 import requests
-import yaml
 import mwclient
-from PIL import Image, ImageFont, ImageDraw
-from qrcode import QRCode
 from pywikibot import Site, Page, FilePage
-from zhconv_rs import zhconv as zhconv_
-
-zhconv = lambda s, v: zhconv_(s, v) if type(s) == str else s
-import img2pdf
+from pywikibot.comms import http
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common import metrics
+from common.throttle import retry, Throttle, ThrottledAdapter
+from plan import load_config, build_manifest, load_manifest, collisions
+from pdfstream import PdfWriter
+from blobstore import BlobStore
+from recompress import Recompressor
+from placeholder import render_jpeg, add_vector_page
+from journal import (
+    Journal,
+    DONE_STATES,
+    DOWNLOADED,
+    UPLOADED,
+    METADATA_UPDATED,
+    SKIPPED,
+    FAILED,
+    MISMATCHED,
+)
 
 
 # from getbook import getbook
 
-CONFIG_FILE_PATH = os.path.join(os.path.dirname(__file__), "config.yml")
-POSITION_FILE_PATH = os.path.join(os.path.dirname(__file__), ".position")
-FONT_FILE_PATH = Path(__file__).parent / "Aileron-Regular.otf"
-DATA_DIR = Path(__file__).parent / "../crawler/data"
+JOURNAL_PATH = Path(__file__).parent / ".journal.ynutcm.sqlite"
 BLOB_DIR = Path(__file__).parent / "blobs"
-CACHE_FILE_PATH = Path(__file__).parent / ".cache.pdf"
+WORK_DIR = Path(__file__).parent / ".work"
 RETRY_TIMES = 3
 CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+DOWNLOAD_CONCURRENCY = 8
+PREFETCH_VOLUMES = 2
+# split evenly between the workers
+PREFETCH_DISK_BUDGET = 4 * 1024 * 1024 * 1024
+BLOB_STORE_MAX_SIZE = 32 * 1024 * 1024 * 1024
+UPLOAD_WORKERS = 1
+# books claimed by a worker at a time
+CLAIM_BOOKS = 4
+# files whose image info is queried at a time when verifying
+VERIFY_BATCH = 50
+# requests per second to the same host, per worker
+DOWNLOAD_RATE = 20
+COMMONS_HOST = "commons.wikimedia.org"
+COMMONS_RATE = 5
+# uploads and edits of all workers together; Commons limits uploads and edits
+# per account unless it has the noratelimit right
+EDITS_PER_MINUTE = 30
 # TEMP_DIR = Path()gettempdir())
 
 USER_AGENT = "ynutcmpd/0.0 (+https://github.com/gowee/ynutcmpd)"
@@ -57,324 +88,739 @@ def call(command, *args, **kwargs):
     return subprocess.check_call(command, *args, **kwargs)
 
 
-def load_position(name):
-    logger.info(f'Loading position from {POSITION_FILE_PATH + "." + name}')
-    if os.path.exists(POSITION_FILE_PATH + "." + name):
-        with open(POSITION_FILE_PATH + "." + name, "r") as f:
-            return f.read().strip()
-    else:
-        return None
-
-
-def store_position(name, position):
-    with open(POSITION_FILE_PATH + "." + name, "w") as f:
-        f.write(position)
+def is_truncated_jpeg(path):
+    # a JPEG must end with an EOI marker, give or take some padding
+    with open(path, "rb") as f:
+        if f.read(2) != JPEG_SOI:
+            return False  # not a JPEG, so nothing to tell
+        f.seek(max(0, f.seek(0, 2) - 1024))
+        return not f.read().rstrip(b"\0\r\n ").endswith(JPEG_EOI)
 
 
-def retry(times=RETRY_TIMES):
-    def wrapper(fn):
-        tried = 0
+@retry(7)
+def fetch_file(url, path, session=None):
+    # Streams `url` to `path`. What an earlier try left in `path` is kept and, if
+    # the server supports Range, only the rest is requested.
+    headers = {"User-Agent": USER_AGENT}
+    offset = path.stat().st_size if path.exists() else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    with (session or requests).get(url, headers=headers, stream=True) as resp:
+        if resp.status_code == 416:
+            # what we have does not fit the file on the server (any more)
+            path.unlink()
+            raise Exception(f"Range {offset}- not satisfiable, starting over")
+        resp.raise_for_status()
+        if resp.status_code == 206:
+            if not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                path.unlink()
+                raise Exception(f"Unexpected {resp.headers.get('Content-Range')}")
+            logger.debug(f"Resuming {url} at {offset} B")
+        else:
+            offset = 0
+        with path.open("ab" if offset else "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        metrics.count("image_bytes", resp.raw.tell())
+        sized = "Content-Length" in resp.headers
+        if sized:
+            # https://blog.petrzemek.net/2018/04/22/on-incomplete-http-reads-and-the-requests-library-in-python/
+            expected_size = int(resp.headers["Content-Length"])
+            actual_size = resp.raw.tell()
+            assert (
+                expected_size == actual_size
+            ), f"Incomplete download: {offset + actual_size}/{offset + expected_size}"
+    assert path.stat().st_size != 0, "Got empty file"
+    if is_truncated_jpeg(path):
+        # a sign of truncation only if nothing told how long the file is, as some
+        # complete scans lack the marker; the truncated file is kept, so the next
+        # try resumes where this one stopped
+        assert sized, f"Truncated JPEG: {path.stat().st_size} B"
+        logger.warning(f"No EOI marker in {url}, keeping it as it is complete")
+    return path
+
+
+# rate limits for the downloads and the Commons API, set up by set_up_throttle
+throttle = Throttle(DOWNLOAD_RATE, {COMMONS_HOST: COMMONS_RATE})
+
+
+def set_up_throttle(config):
+    global throttle
+    throttle = Throttle(
+        config.get("download_rate", DOWNLOAD_RATE),
+        {COMMONS_HOST: config.get("commons_rate", COMMONS_RATE)},
+    )
+    http.session.mount("https://", ThrottledAdapter(throttle))
 
-        @functools.wraps(fn)
-        def wrapped(*args, **kwargs):
-            while True:
-                try:
-                    return fn(*args, **kwargs)
-                except Exception as e:
-                    nonlocal tried
-                    tried += 1
-                    if tried >= times:
-                        raise Exception(f"Failed finally after {times} tries") from e
-                    logger.warning(f"Retrying {fn}", exc_info=e)
 
-        return wrapped
+def pdf_image_urls(image_urls):
+    # -> those of `image_urls` that make it into the PDF, a page each
+    return [url for url in image_urls if url.endswith("jpg") or url.endswith("jpeg")]
 
-    return wrapper
 
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-@retry(7)
-def fetch_file(url, session=None):
-    resp = (session and session.get or requests.get)(
-        url, headers={"User-Agent": USER_AGENT}
-    )
-    resp.raise_for_status()
-    assert len(resp.content) != 0, "Got empty file"
-    if "Content-Length" in resp.headers:
-        # https://blog.petrzemek.net/2018/04/22/on-incomplete-http-reads-and-the-requests-library-in-python/
-        expected_size = int(resp.headers["Content-Length"])
-        actual_size = resp.raw.tell()
-        assert (
-            expected_size == actual_size
-        ), f"Incomplete download: {actual_size}/{expected_size}"
-    return resp.content
-
-def construct_failure_page(url, page_name=""):
-    qr = QRCode(box_size=3)
-    qr.add_data(url)
-    qr.make()
-    qr_img = qr.make_image()
-
-    # ref: https://stackoverflow.com/a/1970930/5488616
-    #      https://stackoverflow.com/a/68648910/5488616
-    #      ChatGPT
-    
-    font = ImageFont.truetype(str(FONT_FILE_PATH), size=20)
-
-    t = datetime.datetime.now(timezone.utc)
-    assert t.tzinfo == timezone.utc
-    if page_name:
-        page_name = " " + page_name
-    texts = [f"The page{page_name} links to an broken url:", *textwrap.wrap(urlquote(url, safe=":/"), break_on_hyphens=False), "Access time: " + str(t)]
-
-    margin = (5, 5)
-    spacing = 3 
-    mask_images = [font.getmask(text, "L") for text in texts]
-    width = max(max(mask_image.size[0] for mask_image in mask_images) ,  qr_img.size[0]) + margin[0] * 2
-    height = sum(mask_image.size[1] for mask_image in mask_images) + margin[1] * 2+ (len(mask_images) - 1) * spacing + spacing + qr_img.size[1]
-    # mask_image = font.getmask(text, "L")
-    img = Image.new("RGB", (width, height), (255,255,255))
-    y = margin[1]
-    for mask_image in mask_images:
-        # need to use the inner `img.im.paste` due to `getmask` returning a core
-        img.im.paste((0,0,0), (margin[0], y, margin[0] + mask_image.size[0], y+mask_image.size[1]), mask_image)
-        y += mask_image.size[1] + spacing
-    img.paste(qr_img, (0, y))
-
-    output = BytesIO()
-    img.save(output, format="JPEG")
-    return output.getvalue()
 
 @retry(3)
-def fetch_volume(filename, image_urls):
-    #return CACHE_FILE_PATH
-    # cached_path = BLOB_DIR / filename
-    # if cached_path.exists():
-    #     with cached_path.open("rb") as f:
-    #         blob = f.read()
-    #         assert blob
-    #         return blob
-    session = requests.Session()  # <del>activate connection reuse</del>
-    image_urls = [url for url in image_urls if url.endswith("jpg") or url.endswith("jpeg")]
-    images = []
-    failures = 0
-    for i, url in enumerate(image_urls):
-        if url.endswith(".db"):
-            continue
+def fetch_volume(
+    filename,
+    image_urls,
+    output_path,
+    concurrency=DOWNLOAD_CONCURRENCY,
+    store=None,
+    recompressor=None,
+    raster_placeholders=False,
+):
+    image_urls = pdf_image_urls(image_urls)
+    pdf_key = "\n".join(image_urls)
+    if recompressor is not None:
+        pdf_key += "\n" + recompressor.key
+    pdf_key = "pdf:" + hashlib.sha256(pdf_key.encode()).hexdigest()
+    if store is not None and store.get(pdf_key, output_path):
+        logger.info(f"PDF for {filename} found in blob store")
+        metrics.count("blob_store_hits", kind="pdf")
+        return output_path
+    # one pooled session per host, shared by all download threads
+    sessions = {}
+    for url in image_urls:
+        host = urlsplit(url).netloc
+        if host not in sessions:
+            sessions[host] = requests.Session()
+            adapter = ThrottledAdapter(throttle, pool_maxsize=concurrency)
+            sessions[host].mount("http://", adapter)
+            sessions[host].mount("https://", adapter)
+
+    def page_name(i):
+        return f"({i+1}/{len(image_urls)})"
+
+    def fetch_page(i, url, spool_dir):
         logger.debug(f"Downloading {url}")
         # assert url.endswith(".jpg"), "Expected JPG: " + url
-        try:
-            image = fetch_file(url, session)
-        except Exception as e:
-            logger.warning(f"Failed to download {url}, using placeholder image", exc_info=e)
-            image = construct_failure_page(url, page_name=f"({i+1}/{len(image_urls)})")
-            failures += 1
-        images.append(image)
-    assert failures < len(image_urls), "Failed to download all images"
-    blob = img2pdf.convert(images)
-    # with cached_path.open("wb") as f:
-    #     f.write(blob)
-    logger.info(f"PDF constructed for {filename} ({len(blob)} B)")
-    with CACHE_FILE_PATH.open("wb") as f:
-        f.write(blob)
-    return CACHE_FILE_PATH
+        path = Path(spool_dir) / f"{i:05d}.jpg"
+        failed = False
+        if store is None or not store.get("url:" + url, path):
+            try:
+                with metrics.timer("image_download"):
+                    fetch_file(url, path, sessions[urlsplit(url).netloc])
+            except Exception as e:
+                logger.warning(
+                    f"Failed to download {url}, using placeholder page", exc_info=e
+                )
+                metrics.count("placeholder_pages")
+                if not raster_placeholders:
+                    # drawn right into the PDF instead
+                    return None, True, 0
+                path.write_bytes(render_jpeg(url, page_name=page_name(i)))
+                failed = True
+            if store is not None and not failed:
+                # the original, so that other options can be tried on it later
+                store.put("url:" + url, path)
+        else:
+            metrics.count("blob_store_hits", kind="url")
+        saved = 0
+        if recompressor is not None and not failed:
+            with metrics.timer("recompress"):
+                before, after = recompressor(path)
+            saved = before - after
+            metrics.count("recompress_saved_bytes", saved)
+        return path, failed, saved
+
+    failures = saved = 0
+    # a fresh file, as the old one may be linked into the blob store
+    output_path.unlink(missing_ok=True)
+    with TemporaryDirectory(prefix="ynutcm-", dir=output_path.parent) as spool_dir:
+        with ThreadPoolExecutor(concurrency) as executor, output_path.open("wb") as f:
+            pdf = PdfWriter(f)
+            # map keeps the page order no matter which download finishes first, so
+            # pages are appended as soon as all pages before them are in
+            pages = executor.map(
+                fetch_page, itertools.count(), image_urls, itertools.repeat(spool_dir)
+            )
+            for i, url, (path, failed, page_saved) in zip(
+                itertools.count(), image_urls, pages
+            ):
+                if path is None:
+                    add_vector_page(pdf, url, page_name(i))
+                else:
+                    with metrics.timer("pdf_page"):
+                        pdf.add_jpeg(path)
+                    path.unlink()
+                failures += failed
+                saved += page_saved
+            assert failures < len(image_urls), "Failed to download all images"
+            pdf.close()
+    logger.info(f"PDF constructed for {filename} ({output_path.stat().st_size} B)")
+    metrics.count("pdf_bytes", output_path.stat().st_size)
+    if recompressor is not None:
+        logger.info(f"Recompression saved {saved} B on {filename}")
+    # not keeping placeholders around, so the failed pages are retried next time
+    if store is not None and failures == 0:
+        store.put(pdf_key, output_path)
+    return output_path
+
+
+# Downloads the volumes to be uploaded next in the background, so that the link
+# to the source server is kept busy while the current volume is being uploaded.
+#
+# Each volume goes to its own file under WORK_DIR, which is deleted once the
+# volume is released. No new download starts while the finished ones that have
+# not been released yet take up `disk_budget` bytes or more.
+class Prefetcher:
+    def __init__(
+        self,
+        lookahead,
+        disk_budget,
+        concurrency,
+        store=None,
+        recompressor=None,
+        raster_placeholders=False,
+    ):
+        self.lookahead = lookahead
+        self.disk_budget = disk_budget
+        self.concurrency = concurrency
+        self.store = store
+        self.recompressor = recompressor
+        self.raster_placeholders = raster_placeholders
+        self.futures = {}
+        self.sizes = {}
+        self.disk_used = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        # the pages of a volume are downloaded in parallel already
+        self.executor = ThreadPoolExecutor(1)
+
+    def __enter__(self):
+        WORK_DIR.mkdir(exist_ok=True)
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.executor.shutdown(cancel_futures=True)
+        for filename in list(self.futures):
+            self.release(filename)
+
+    @staticmethod
+    def path(filename):
+        return WORK_DIR / urlquote(filename, safe="")
+
+    def submit(self, filename, image_urls):
+        if filename not in self.futures:
+            self.futures[filename] = self.executor.submit(
+                self._fetch, filename, image_urls
+            )
 
+    def _fetch(self, filename, image_urls):
+        with self.cond:
+            self.cond.wait_for(lambda: self.disk_used < self.disk_budget or self.closed)
+            if self.closed:
+                raise Exception("Prefetcher closed")
+        logger.info(f"Downloading images for {filename}")
+        with metrics.timer("volume_fetch"):
+            path = fetch_volume(
+                filename,
+                image_urls,
+                self.path(filename),
+                self.concurrency,
+                self.store,
+                self.recompressor,
+                self.raster_placeholders,
+            )
+        with self.cond:
+            self.sizes[filename] = path.stat().st_size
+            self.disk_used += self.sizes[filename]
+        return path
+
+    def take(self, filename):
+        return self.futures[filename].result()
+
+    def release(self, filename):
+        self.futures.pop(filename, None)
+        self.path(filename).unlink(missing_ok=True)
+        with self.cond:
+            self.disk_used -= self.sizes.pop(filename, 0)
+            self.cond.notify_all()
+
+
+# Spaces out the uploads and edits of all worker processes, so that together
+# they stay within the rate limits of Commons.
+class RateLimit:
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.next_slot = multiprocessing.Value("d", 0.0)
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.next_slot.get_lock():
+            now = time.time()
+            slot = max(self.next_slot.value, now)
+            self.next_slot.value = slot + self.interval
+        metrics.count("rate_limit_wait_seconds", slot - now)
+        time.sleep(slot - now)
+
+
+# shared with the worker processes by init_worker
+rate_limit = None
+stop = None
+
+
+def init_worker(rate_limit_, stop_, worker_process=False):
+    global rate_limit, stop
+    rate_limit, stop = rate_limit_, stop_
+    if worker_process:
+        # only what the worker records, which main merges into its own
+        metrics.registry.reset()
+
+
+def needs_upload(job, states):
+    return job["image_urls"] and (
+        not job["page"].exists() or states[job["filename"]] == MISMATCHED
+    )
 
-def main():
-    with open(CONFIG_FILE_PATH, "r") as f:
-        config = yaml.safe_load(f.read())
 
-    username, password = config["username"], config["password"]
-    site = Site("commons")
-    site.login()
-    # site.login(username, password)
-    # site.requests["timeout"] = 125
-    # site.chunk_size = 1024 * 1024 * 64
+def record(journal, filename, state, reason=None):
+    journal.record(filename, state, reason)
+    metrics.count("volumes", state=state)
 
-    # logger.info(f"Signed in as {username}")
-    logger.info("Up")
 
+def upload_volume(job, site, config, states, journal, prefetcher):
+    # Uploads the PDF of a volume, or brings the wikitext of its file up to date.
+    # -> "changed", "unchanged" or "failures", for the counts, or None
     def getopt(item, default=None):
         return config.get(item, config.get(item, default))
 
-    book_paths = sorted(DATA_DIR.glob("*.json"))
-
-    template = getopt("template")
     batch_link = getopt("link") or getopt("name")
+    category_page = job["category_page"]
+    filename, page = job["filename"], job["page"]
+    pagename = page.title()
+    volume_wikitext, comment = job["wikitext"], job["comment"]
+
+    # TODO: for now we do not create a seperated category suffixed with the edition
+    # category pages of the books are left alone unless asked for
+    if getopt("create_categories", False) and not category_page.exists():
+        category_page.text = job["category_wikitext"]
+        rate_limit.wait()
+        with metrics.timer("page_save"):
+            category_page.save(
+                f"Creating (batch task; ynutcm; {batch_link})",
+            )
+    # print(volume_wikitext)
+    if not job["image_urls"]:
+        logger.warning(f"No images for {pagename}!")
+        record(journal, filename, SKIPPED, "no images")
+        return None
+    try:
+        if needs_upload(job, states):
+            ignored_warnings = ["was-deleted"]
+            if states[filename] == MISMATCHED:
+                # found to differ by a verification, so replaced
+                ignored_warnings.append("exists")
+
+            @retry(RETRY_TIMES)
+            def do1():
+                rate_limit.wait()
+                with metrics.timer("upload"):
+                    r = site.upload(
+                        source_filename=binary,
+                        filepage=page,
+                        text=volume_wikitext,
+                        comment=comment,
+                        asynchronous=True,
+                        chunk_size=CHUNK_SIZE,
+                        ignore_warnings=ignored_warnings,
+                        # report_success=True,
+                    )
+                assert r, "Upload failed"
+                metrics.count("upload_bytes", binary.stat().st_size)
+                # assert (
+                #     r.get("result") or r.get("upload", {}).get("result")
+                # ) == "Success" or (r or {}).get("warnings", {}).get(
+                #     "exists"
+                # ), f"Upload failed {r}"
 
-    booknavi = getopt("booknavi")
+            try:
+                binary = prefetcher.take(filename)
+                record(journal, filename, DOWNLOADED)
+                sha1 = file_sha1(binary)
+                size = binary.stat().st_size
+                logger.info(f"Uploading {pagename}")
+                do1()
+            finally:
+                prefetcher.release(filename)
+            journal.record_file(filename, sha1, size)
+            record(journal, filename, UPLOADED)
+            return None
+        if getopt("skip_on_existing", False):
+            logger.debug(f"{pagename} exists, skipping")
+            record(journal, filename, SKIPPED, "exists")
+            return None
+        # MediaWiki strips trailing whitespace on save
+        if page.text.rstrip() == volume_wikitext.rstrip():
+            logger.debug(f"{pagename} is up to date, skipping")
+            if states[filename] not in DONE_STATES:
+                record(journal, filename, METADATA_UPDATED)
+            return "unchanged"
+        logger.info(f"{pagename} exists, updating wikitext")
+
+        @retry(RETRY_TIMES)
+        def do2():
+            rate_limit.wait()
+            page.text = volume_wikitext
+            with metrics.timer("page_save"):
+                r = page.save(comment + " (Updating metadata)")
+            # assert (r or {}).get(
+            #     "result", {}
+            # ) == "Success", f"Update failed {r}"
+            assert r, f"Update failed {repr(r)}"
+
+        do2()
+        record(journal, filename, METADATA_UPDATED)
+        return "changed"
+    except Exception as e:
+        logger.warning("Upload failed", exc_info=e)
+        record(journal, filename, FAILED, repr(e.__cause__ or e))
+        if not getopt("skip_on_failures", False):
+            stop.set()
+            raise e
+        return "failures"
+
+
+def upload_books(books, config, states, started, worker=0, workers=1):
+    # Uploads the volumes of `books`, claiming them in the journal a few books at
+    # a time so that workers sharing the journal never take the same book, nor
+    # one that another worker of the run started at `started` is done with.
+    # The `workers` of the run split the disk budget for prefetching between them.
+    # -> Counter of failures, changed and unchanged files, and a snapshot of the
+    #    metrics of the process
+    def getopt(item, default=None):
+        return config.get(item, config.get(item, default))
 
-    last_position = load_position("ynutcm")
+    set_up_throttle(config)
 
-    if last_position is not None:
-        book_paths = iter(book_paths)
-        logger.info(f"Last processed: {last_position}")
-        next(
-            itertools.dropwhile(
-                lambda book_path: str(book_path) != last_position, book_paths
-            )
-        )  # lazy!
-        # TODO: peek and report?
-
-    failcnt = 0
-
-    for path in book_paths:
-        with open(path) as f:
-            book = json.load(f)
-        urlid = int(path.stem)
-        title = zhconv(book["detail"]["title"], "zh-hant")
-        category_name = "Category:" + title
-        byline = zhconv(book["detail"]["author"] or "", "zh-hant")
-        if getopt("apply_tortoise_shell_brackets_to_starting_of_byline", False):
-            # e.g. "(魏)王弼,(晋)韩康伯撰   (唐)邢璹撰"
-            byline = re.sub(
-                r"^([（(〔[][题題][]）)〕])?[（(〔[](.{0,3}?)[]）)〕]",
-                r"\1〔\2〕",
-                byline,
+    site = Site("commons")
+    # with the session main logged in with, so that the workers do not log in
+    # over each other in the cookie file they share
+    site.login(cookie_only=True)
+    logger.info(f"Worker {worker} up")
+
+    journal = Journal(getopt("journal", JOURNAL_PATH))
+    owner = f"{socket.gethostname()}/{os.getpid()}"
+    books_by_path = {book["path"]: book for book in books}
+    unclaimed = iter(books_by_path)
+
+    store = None
+    if getopt("blob_store_size", BLOB_STORE_MAX_SIZE):
+        store = BlobStore(BLOB_DIR, getopt("blob_store_size", BLOB_STORE_MAX_SIZE))
+
+    recompressor = None
+    if getopt("recompress"):
+        # e.g. {"quality": 80, "max_dimension": 4000, "grayscale": true}
+        recompressor = Recompressor(**getopt("recompress"))
+
+    counts = Counter()
+    try:
+        with Prefetcher(
+            getopt("prefetch_volumes", PREFETCH_VOLUMES),
+            getopt("prefetch_disk_budget", PREFETCH_DISK_BUDGET) // workers,
+            getopt("download_concurrency", DOWNLOAD_CONCURRENCY),
+            store,
+            recompressor,
+            # placeholders rasterized to JPEGs as they used to be, not vector pages
+            getopt("raster_placeholders", False),
+        ) as prefetcher:
+            while not stop.is_set():
+                claimed = journal.claim(
+                    unclaimed, owner, getopt("claim_books", CLAIM_BOOKS), started
+                )
+                if not claimed:
+                    break
+
+                category_pages = {}
+                jobs = []
+                for book_path in claimed:
+                    book = books_by_path[book_path]
+                    category_name = book["category_name"]
+                    if category_name not in category_pages:
+                        category_pages[category_name] = Page(site, category_name)
+                    for volume in book["volumes"]:
+                        jobs.append(
+                            {
+                                **volume,
+                                "book_path": book_path,
+                                "category_page": category_pages[category_name],
+                                "category_wikitext": book["category_wikitext"],
+                                "page": FilePage(site, volume["pagename"]),
+                            }
+                        )
+
+                # existence and current text of every page the jobs touch, so that
+                # they are not checked one by one
+                pages = [job["page"] for job in jobs]
+                if getopt("create_categories", False):
+                    pages += category_pages.values()
+                logger.info(f"Checking {len(pages)} pages")
+                for _ in site.preloadpages(pages):
+                    pass
+                jobs = peekable(jobs)
+                for job in jobs:
+                    if stop.is_set():  # another worker failed
+                        break
+                    # keep the next volumes downloading while this one is processed
+                    for upcoming in [job, *jobs[: prefetcher.lookahead]]:
+                        if needs_upload(upcoming, states):
+                            prefetcher.submit(
+                                upcoming["filename"], upcoming["image_urls"]
+                            )
+                    outcome = upload_volume(
+                        job, site, config, states, journal, prefetcher
+                    )
+                    if outcome:
+                        counts[outcome] += 1
+    finally:
+        # the claims of a worker that is done, which would hold the books off
+        # until release_stale found the process gone, if ever
+        journal.release(owner)
+    if recompressor is not None:
+        recompressor.shutdown()
+    return counts, metrics.registry.snapshot()
+
+
+@retry(RETRY_TIMES)
+def imageinfo(site, titles):
+    # -> title -> image info, with the size, SHA-1 and page count, of those of
+    # `titles` that exist
+    query = (
+        site.simple_request(
+            action="query", prop="imageinfo", iiprop="size|sha1", titles=titles
+        )
+        .submit()
+        .get("query", {})
+    )
+    # the titles asked for, by what MediaWiki normalized them to
+    asked = {entry["to"]: entry["from"] for entry in query.get("normalized", [])}
+    pages = query.get("pages", {})
+    infos = {}
+    for page in pages.values() if isinstance(pages, dict) else pages:
+        if page.get("imageinfo"):
+            infos[asked.get(page["title"], page["title"])] = page["imageinfo"][0]
+    return infos
+
+
+def check_file(volume, info, uploaded=None):
+    # -> what is wrong with the file of `volume` as Commons has it, if anything,
+    # given its image info and the SHA-1 and size of what was uploaded for it
+    if info is None:
+        return "missing"
+    sha1, size = uploaded or (None, None)
+    pages = len(pdf_image_urls(volume["image_urls"]))
+    if size is not None and info["size"] < size:
+        return f"truncated: {info['size']}/{size} B"
+    # MediaWiki could not make out the pages of a PDF that is cut short
+    if info.get("pagecount") is None:
+        return f"truncated: no page count, {pages} expected"
+    if info["pagecount"] < pages:
+        return f"truncated: {info['pagecount']}/{pages} pages"
+    if sha1 is not None and info["sha1"] != sha1:
+        return f"mismatched: SHA-1 {info['sha1']}, {sha1} uploaded"
+    if info["pagecount"] != pages:
+        return f"mismatched: {info['pagecount']}/{pages} pages"
+    return None
+
+
+def verify(volumes, config, journal):
+    # Checks the files of `volumes` on Commons against the manifest and what was
+    # uploaded, querying the image info of VERIFY_BATCH files at a time instead
+    # of downloading anything. Files that are missing or differ are marked as
+    # mismatched in the journal, so that the next run uploads them again.
+    # -> filename -> what is wrong with the file
+    set_up_throttle(config)
+    site = Site("commons")
+    uploaded = journal.files()
+    problems = {}
+    for batch in chunked(volumes, VERIFY_BATCH):
+        logger.info(f"Verifying {len(batch)} files from {batch[0]['pagename']}")
+        infos = imageinfo(site, [volume["pagename"] for volume in batch])
+        for volume in batch:
+            filename = volume["filename"]
+            problem = check_file(
+                volume, infos.get(volume["pagename"]), uploaded.get(filename)
             )
+            metrics.count("verified", result=problem.split(":")[0] if problem else "ok")
+            if problem:
+                logger.warning(f"{volume['pagename']}: {problem}")
+                journal.record(filename, MISMATCHED, problem)
+                problems[filename] = problem
+    return problems
 
-        def genvols():
-            for ivol, (volume_name, volume_path, image_urls) in enumerate(
-                map(lambda triple: triple.values(), book["fulltextpath"])
-            ):
-                # pagename = "File:" + book['name'] + ".pdf"
-                # volume_name = f"第{ivol+1}冊" if len(volurls) > 1 else ""
-                # volume_name_wps = (
-                #    (" " + volume_name) if volume_name else ""
-                # )  # with preceding space
-                volume_name = re.sub(
-                    r"\s+",
-                    " ",
-                    (
-                        volume_name.strip()
-                        .replace("(", "（")
-                        .replace(")", "）")
-                        .replace("{", "（")
-                        .replace("}", "）")
-                    ),
-                )
-                volume_name_simplified = re.sub(
-                    r"[0-9-]+(.+?)[0-9-]+$", r"\1", volume_name
-                )
-                filename = zhconv(f"YNUTCM-{volume_name}.pdf", "zh-hant")
-                pagename = "File:" + filename
-                assert all(char not in set(r'["$*|\]</^>@#') for char in pagename)
-                comment = f'Upload {title} {volume_name} ({1+ivol}/{len(book["fulltextpath"])}) by {book["detail"]["author"]} (batch task; ynutcm; {batch_link}; [[{category_name}|{title}]])'
-                yield ivol + 1, filename, pagename, byline, volume_name, volume_path, volume_name_simplified, image_urls, comment
-
-        volsit = peekable(genvols())
-        prev_filename = None
-        for (
-            nth,
-            filename,
-            pagename,
-            byline,
-            volume_name,
-            volume_path,
-            volume_name_simplified,
-            image_urls,
-            comment,
-        ) in volsit:
-            try:
-                next_filename = volsit.peek()[1]
-            except StopIteration:
-                next_filename = None
-            additional_fields = "\n".join(
-                [
-                    f"  |JSONFIELD-{k}={zhconv('' if v is None else v, 'zh-hant')}"
-                    for k, v in book["detail"].items()
-                ]
-                + [
-                    f"  |JSONFIELD-{k}-original={'' if v is None else v}"
-                    for k, v in book["detail"].items()
-                ]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        help="upload what a manifest written by plan.py lists, instead of planning afresh",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help=f"number of worker processes (default: {UPLOAD_WORKERS})",
+    )
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="only process the volumes that failed last time",
+    )
+    selection.add_argument(
+        "--all",
+        action="store_true",
+        help="also process the volumes the journal has as done",
+    )
+    selection.add_argument(
+        "--verify",
+        action="store_true",
+        help="check the files the journal has as done against Commons instead of"
+        " uploading, and mark those that are missing or differ for the next run",
+    )
+    parser.add_argument(
+        "--release-claims",
+        action="store_true",
+        help="release the books claimed by other runs first, e.g. of a host that"
+        " is gone; only while no other run is going",
+    )
+    args = parser.parse_args()
+
+    config = load_config()
+    logger.info("Up")
+
+    def getopt(item, default=None):
+        return config.get(item, config.get(item, default))
+
+    workers = args.workers or getopt("upload_workers", UPLOAD_WORKERS)
+    # e.g. metrics_file: metrics.json, metrics_port: 9108
+    metrics.registry.export(getopt("metrics_file"), getopt("metrics_port"))
+
+    if args.manifest:
+        manifest = load_manifest(args.manifest)
+    else:
+        manifest = build_manifest(config)
+
+    # volumes sharing a file name would overwrite each other on Commons, so none
+    # of them is uploaded; each name is journaled once, as failed
+    duplicated = set(collisions(manifest))
+    colliding = {}
+    for book in manifest:
+        for volume in book["volumes"]:
+            if volume["filename"] in duplicated:
+                colliding.setdefault(volume["filename"], (book["path"], volume["nth"]))
+        book["volumes"] = [
+            volume for volume in book["volumes"] if volume["filename"] not in duplicated
+        ]
+
+    journal = Journal(getopt("journal", JOURNAL_PATH))
+    journal.plan(
+        (volume["filename"], book["path"], volume["nth"])
+        for book in manifest
+        for volume in book["volumes"]
+    )
+    journal.plan(
+        (filename, book_path, nth) for filename, (book_path, nth) in colliding.items()
+    )
+    for filename in sorted(colliding):
+        logger.error(f"Colliding file name, not uploaded: {filename}")
+        journal.record(filename, FAILED, "colliding file name")
+    journal.release_stale()
+    for owner, count in sorted(journal.claims().items()):
+        if args.release_claims:
+            logger.info(f"Releasing the claims of {owner}")
+            journal.release(owner)
+        else:
+            logger.warning(
+                f"{count} books are claimed by {owner}, so they are skipped; if it"
+                " is gone, run again with --release-claims"
             )
-            category_page = Page(site, category_name)
-            # TODO: for now we do not create a seperated category suffixed with the edition
-            if not category_page.exists:
-                category_wikitext = (
-                    """{{Wikidata Infobox}}
-{{Category for book|zh}}
-{{zh|%s}}
-
-[[Category:Chinese-language books by title]]
-    """
-                    % title
-                )
-                category_page.text = category_wikitext
-                category_page.save(
-                    f"Creating (batch task; ynutcm; {batch_link})",
+    states = journal.states()
+    logger.info(f"Journal: {journal.summary()}")
+
+    if args.verify:
+        volumes = [
+            volume
+            for book in manifest
+            for volume in book["volumes"]
+            if volume["image_urls"] and states[volume["filename"]] in DONE_STATES
+        ]
+        problems = verify(volumes, config, journal)
+        logger.info(
+            f"Verified {len(volumes)} files, {len(problems)} of them to be uploaded"
+            " again"
+        )
+        logger.info(f"Journal: {journal.summary()}")
+        return
+
+    def selected(volume):
+        state = states[volume["filename"]]
+        if args.retry_failed:
+            return state == FAILED
+        return args.all or state not in DONE_STATES
+
+    books = []
+    for book in manifest:
+        volumes = [volume for volume in book["volumes"] if selected(volume)]
+        if volumes:
+            books.append({**book, "volumes": volumes})
+
+    username, password = config["username"], config["password"]
+    site = Site("commons")
+    # once, as the workers share the cookie file of pywikibot
+    site.login()
+    # site.login(username, password)
+    # site.requests["timeout"] = 125
+    # site.chunk_size = 1024 * 1024 * 64
+
+    # logger.info(f"Signed in as {username}")
+
+    started = time.time()
+    init_args = (
+        RateLimit(getopt("edits_per_minute", EDITS_PER_MINUTE)),
+        multiprocessing.Event(),
+    )
+    if workers == 1:
+        init_worker(*init_args)
+        counts, _ = upload_books(books, config, states, started)
+    else:
+        logger.info(f"Uploading {len(books)} books with {workers} workers")
+        counts = Counter()
+        with ProcessPoolExecutor(
+            workers, initializer=init_worker, initargs=(*init_args, True)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    upload_books, books, config, states, started, worker, workers
                 )
-            volume_wikitext = f"""=={{{{int:filedesc}}}}==
-{{{{{booknavi}|prev={prev_filename or ""}|next={next_filename or ""}|nth={nth}|total={len(book["fulltextpath"])}|number={book["detail"]["number"]}|totalnum={book["detail"]["totalnum"]}|callnum={book["detail"]["callnum"]}|docNo={book["detail"]["docNo"]}|class={zhconv(book["detail"]["class"], "zh-Hant")}}}}}
-{{{{{template}
-  |bookurlid={urlid}
-  |volname={zhconv(volume_name, 'zh-hant')}
-  |volname-original={volume_name}
-  |volpath={zhconv(volume_path, 'zh-hant')}
-  |volpath-original={volume_path}
-  |simpvolname={zhconv(volume_name_simplified, 'zh-hant')}
-  |byline={byline}
-{additional_fields}
-}}}}
-
-[[{category_name}]]
-    """
-            # print(volume_wikitext)
-            if not image_urls:
-                logger.warning(f"No images for {pagename}!")
-                continue
-            page = FilePage(site, pagename)
-            try:
-                if not page.exists():
-                    logger.info(f"Downloading images for {pagename}")
-                    binary = fetch_volume(filename, image_urls)
-                    logger.info(f"Uploading {pagename}")
-
-                    @retry()
-                    def do1():
-                        r = site.upload(
-                            source_filename=binary,
-                            filepage=page,
-                            text=volume_wikitext,
-                            comment=comment,
-                            asynchronous=True,
-                            chunk_size=CHUNK_SIZE,
-                            ignore_warnings=["was-deleted"],
-                            # report_success=True,
-                        )
-                        assert r, "Upload failed"
-                        # assert (
-                        #     r.get("result") or r.get("upload", {}).get("result")
-                        # ) == "Success" or (r or {}).get("warnings", {}).get(
-                        #     "exists"
-                        # ), f"Upload failed {r}"
-
-                    do1()
-                else:
-                    if getopt("skip_on_existing", False):
-                        logger.debug(f"{pagename} exists, skipping")
-                    else:
-                        logger.info(f"{pagename} exists, updating wikitext")
-
-                        @retry()
-                        def do2():
-                            page.text = volume_wikitext
-                            r = page.save(comment + " (Updating metadata)")
-                            # assert (r or {}).get(
-                            #     "result", {}
-                            # ) == "Success", f"Update failed {r}"
-                            assert r, f"Update failed {repr(r)}"
-
-                        do2()
-            except Exception as e:
-                failcnt += 1
-                logger.warning("Upload failed", exc_info=e)
-                if not getopt("skip_on_failures", False):
-                    raise e
-            prev_filename = filename
-        # input("Press any key to continue")
-        store_position("ynutcm", str(path))
-    # logger.info(f"Batch done with {failcnt} failures.")
+                for worker in range(workers)
+            ]
+            # the metrics of the workers only show once they are done
+            for future in futures:
+                worker_counts, snapshot = future.result()
+                counts += worker_counts
+                metrics.registry.merge(snapshot)
+
+    logger.info(
+        f"Batch done with {counts['failures']} failures. Metadata of"
+        f" {counts['changed']} existing files updated, {counts['unchanged']}"
+        " unchanged."
+    )
+    for filename, reason, attempts in journal.failures():
+        logger.warning(f"Failed {attempts} time(s): {filename}: {reason}")
+    logger.info(f"Journal: {journal.summary()}")
 
 
 if __name__ == "__main__":